@@ -0,0 +1,69 @@
+"""Times TTS save generation on a synthetic 5,000 counter faction, per-call json.loads templates vs the TemplateRegistry."""
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import import_tts
+
+
+def synthetic_faction(countries=2, formations=25, units=100):
+    data = {}
+    for c in range(countries):
+        country = {}
+        for f in range(formations):
+            formation = {}
+            for u in range(units):
+                png = "Unit_{0}_{1}_{2}".format(c, f, u)
+                formation["Unit {0}".format(u)] = {
+                    "front_png":        png + "_F.png",
+                    "front_png_url":    "https://steamusercontent.com/ugc/{0}_F/".format(png),
+                    "back_png":         png + "_B.png",
+                    "back_png_url":     "https://steamusercontent.com/ugc/{0}_B/".format(png)
+                }
+            country["Formation {0}".format(f)] = formation
+        data["Country {0}".format(c)] = country
+    return data
+
+
+def legacy_get_template(name, path=(), guids=None):
+    # getTemplate as it was before the registry: one full parse per object
+    templates = json.loads(template_str)
+    template = templates[name]
+    template['GUID'] = str(uuid.uuid4())[:6]
+    return template
+
+
+def time_save(faction_data, repeat):
+    best = None
+    for _ in range(repeat):
+        guids = import_tts.GuidRegistry()
+        start = time.perf_counter()
+        counter_bag = import_tts.getTemplate('bag', import_tts.counterRoot, guids)
+        counter_bag['ContainedObjects'] = [import_tts.createCounterBox(faction_data, 'NATO', 'NATO', guids)]
+        tts_save = import_tts.getTemplate('ttsSave', (), guids)
+        tts_save['ObjectStates'] = [counter_bag]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    with open(os.path.join(os.path.dirname(import_tts.__file__), "templates.json")) as template_file:
+        template_str = template_file.read()
+
+    faction_data = synthetic_faction()
+    repeat = 3
+
+    registry_get_template = import_tts.getTemplate
+    import_tts.getTemplate = legacy_get_template
+    before = time_save(faction_data, repeat)
+    import_tts.getTemplate = registry_get_template
+    after = time_save(faction_data, repeat)
+
+    print(f"counters:     {sum(len(units) for country in faction_data.values() for units in country.values())}")
+    print(f"json.loads:   {before:.3f}s")
+    print(f"registry:     {after:.3f}s")
+    print(f"speedup:      {before / after:.1f}x")
@@ -0,0 +1,95 @@
+"""Peak and retained memory (tracemalloc) of parsing a large synthetic buildFile.xml straight out of a vmod,
+fails when the parsed records keep more than a bound per unit or still hold on to their XML."""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from zipfile import ZipFile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import redstrike_vassal_parse_xml as parser
+
+
+def piece_slot(name, pngs):
+    return '<VASSAL.build.widget.PieceSlot entryName="{0}" gpid="0" height="0" width="0">+/null/prototype;Unit\tpiece;;;{1};{0}/\t\\\\null;0;0;0</VASSAL.build.widget.PieceSlot>'.format(name, pngs)
+
+
+def synthetic_buildfile(nations=10, commands=20, units=50):
+    pngs = []
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="no"?><VASSAL.build.GameModule name="Red Strike">',
+             '<VASSAL.build.module.PieceWindow name="Counters"><VASSAL.build.widget.TabWidget entryName="Counters">']
+    for faction in ("NATO Units", "WP Units"):
+        parts.append('<VASSAL.build.widget.TabWidget entryName="{0}">'.format(faction))
+        for n in range(nations):
+            parts.append('<VASSAL.build.widget.TabWidget entryName="Nation {0}">'.format(n))
+            for c in range(commands):
+                parts.append('<VASSAL.build.widget.ListWidget entryName="Command {0}">'.format(c))
+                for u in range(units):
+                    front, back = "{0}_{1}_{2}_{3}_F.png".format(faction[:2], n, c, u), "{0}_{1}_{2}_{3}_B.png".format(faction[:2], n, c, u)
+                    pngs += [front, back]
+                    parts.append(piece_slot("Unit {0}".format(u), front + "," + back))
+                parts.append('</VASSAL.build.widget.ListWidget>')
+            parts.append('</VASSAL.build.widget.TabWidget>')
+        parts.append('</VASSAL.build.widget.TabWidget>')
+    parts.append('</VASSAL.build.widget.TabWidget></VASSAL.build.module.PieceWindow></VASSAL.build.GameModule>')
+    return "".join(parts), pngs
+
+
+def parsed_objects(factions, decks, markers):
+    yield from factions
+    for faction in factions:
+        for _, node in parser.walk_hierarchy(faction):
+            yield node
+    for deck in decks:
+        yield deck
+        yield from deck.cards
+    for category in markers:
+        yield category
+        yield from category.markers
+
+
+def holding_xml(objects):
+    # type names of the parsed objects that still expose the raw xmltodict data
+    return sorted({type(obj).__name__ for obj in objects if hasattr(obj, "xml_data") or hasattr(obj, "_xml_data")})
+
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description=__doc__)
+    arguments.add_argument("--max-retained-per-unit", type=int, default=1024, help="bytes of parsed data allowed per unit")
+    args = arguments.parse_args()
+
+    buildfile, pngs = synthetic_buildfile()
+    bson_data = {str(i): {"Name": png, "URL": "https://steamusercontent.com/ugc/{0}/".format(i)} for i, png in enumerate(pngs)}
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vmod_path = os.path.join(temp_dir, "synthetic.vmod")
+        with ZipFile(vmod_path, "w") as vmod_zip:
+            vmod_zip.writestr("buildFile.xml", buildfile)
+        cloud_index = parser.CloudIndex(bson_data)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        factions, decks, markers = parser.parse_redstrike_vmod(vmod_path, cloud_index)
+        elapsed = time.perf_counter() - start
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    units = sum(1 for faction in factions for _, node in parser.walk_hierarchy(faction) if type(node) is parser.UnitRecord)
+    print(f"buildFile.xml: {len(buildfile) / 2**20:.1f} MiB, {units} units")
+    print(f"parse time:    {elapsed:.2f}s")
+    print(f"peak memory:   {peak / 2**20:.1f} MiB")
+    print(f"retained:      {retained / 2**20:.1f} MiB, {retained / units:.0f} bytes per unit")
+
+    failed = False
+    if retained > args.max_retained_per_unit * units:
+        print(f"FAIL:  {retained} bytes retained, more than {args.max_retained_per_unit} per unit ({args.max_retained_per_unit * units})")
+        failed = True
+    xml_holders = holding_xml(parsed_objects(factions, decks, markers))
+    if xml_holders:
+        print(f"FAIL:  {', '.join(xml_holders)} still keep their xml data")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("Retained memory within bounds, no parsed object keeps its xml data.")
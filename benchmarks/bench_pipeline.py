@@ -0,0 +1,120 @@
+"""Image hashing, URL resolution, parse, tagging and TTS export throughput on synthetic vmods at 1x/10x/100x, compared against a saved baseline."""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "unit_tags"))
+import import_tts
+import pipeline
+import process
+import redstrike_vassal_parse_xml as parser
+from synthetic_vmod import build_synthetic_vmod
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pipeline_baseline.json")
+
+
+def timed(stage, items, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    return result, {"stage": stage, "items": items(result), "seconds": elapsed, "per_second": items(result) / elapsed}
+
+
+def count_pieces(parsed):
+    factions, decks, markers = parsed
+    units = sum(1 for faction in factions for _, node in parser.walk_hierarchy(faction) if type(node) is parser.UnitRecord)
+    return units + sum(len(deck.cards) for deck in decks) + sum(len(category.markers) for category in markers)
+
+
+def resolve_urls(bson_path, content_hashes):
+    cloud_index = parser.CloudIndex(parser.parse_bson(bson_path))
+    cloud_index.dedupe(content_hashes)
+    for png in cloud_index.urls:
+        cloud_index.lookup(png)
+    return cloud_index
+
+
+def hash_images(vmod_path, bson_path):
+    # uncached, every png in CloudInfo is decoded
+    return parser.image_content_hashes(vmod_path, parser.CloudIndex(parser.parse_bson(bson_path)).urls)
+
+
+def tag(vmod_path, templates_path, workers):
+    return process.classify_units(pipeline.crop_stage(vmod_path), templates_path, workers)
+
+
+def export(factions, decks, save_path):
+    guids = import_tts.GuidRegistry()
+    tts_save = import_tts.buildSave(parser.hierarchy_data(factions), parser.decks_data(decks), guids=guids)
+    with open(save_path, 'w') as save_file:
+        import_tts.dumpSave(tts_save, save_file)
+    return guids.paths
+
+
+def bench_scale(scale, workers):
+    with tempfile.TemporaryDirectory() as work_dir:
+        vmod_path, bson_path, templates_path = build_synthetic_vmod(work_dir, scale)
+        results = []
+
+        content_hashes, result = timed("image hashing", len, hash_images, vmod_path, bson_path)
+        results.append(result)
+        cloud_index, result = timed("url resolution", lambda index: len(index.requested), resolve_urls, bson_path, content_hashes)
+        results.append(result)
+        parsed, result = timed("parse", count_pieces, parser.parse_redstrike_vmod, vmod_path, cloud_index)
+        results.append(result)
+        entries, result = timed("tagging", len, tag, vmod_path, templates_path, workers)
+        results.append(result)
+        untagged = sum(1 for entry in entries if "_F_" in entry.filename and (entry.unit_type is None or entry.unit_formation is None))
+        if untagged:
+            print(f"WARN:  {untagged} synthetic counters were not tagged")
+        factions, decks, _ = parsed
+        _, result = timed("export", len, export, factions, decks, os.path.join(work_dir, "RS89_Tokens.json"))
+        results.append(result)
+    return results
+
+
+def regressions(current, baseline, tolerance):
+    # a stage regresses when its throughput drops more than tolerance below the baseline at the same scale
+    failed = []
+    for scale, results in current.items():
+        for result in results:
+            previous = {r["stage"]: r for r in baseline.get(scale, [])}.get(result["stage"])
+            if previous is not None and result["per_second"] < previous["per_second"] * (1 - tolerance):
+                failed.append((scale, result["stage"], previous["per_second"], result["per_second"]))
+    return failed
+
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description=__doc__)
+    arguments.add_argument("scales", nargs="*", type=int, default=[1, 10, 100])
+    arguments.add_argument("--workers", type=int, default=1, help="classification processes, 1 keeps tagging comparable across machines")
+    arguments.add_argument("--baseline", default=BASELINE_PATH)
+    arguments.add_argument("--save-baseline", action="store_true", help="store this run as the baseline instead of comparing")
+    arguments.add_argument("--tolerance", type=float, default=0.25, help="allowed throughput drop before a stage fails")
+    args = arguments.parse_args()
+
+    current = {}
+    for scale in args.scales:
+        current[str(scale)] = bench_scale(scale, args.workers)
+        for result in current[str(scale)]:
+            print(f"{scale:>4}x  {result['stage']:<15} {result['items']:>8} items  {result['seconds']:8.3f}s  {result['per_second']:10.0f}/s")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(current, baseline_file, indent=4)
+        print(f"Saved baseline to {args.baseline}")
+    elif not os.path.exists(args.baseline):
+        print(f"NO BASELINE:  {args.baseline} does not exist, nothing compared. Record one with --save-baseline.")
+        sys.exit(2)
+    else:
+        with open(args.baseline) as baseline_file:
+            failed = regressions(current, json.load(baseline_file), args.tolerance)
+        for scale, stage, before, after in failed:
+            print(f"REGRESSION:  {stage} at {scale}x, {before:.0f}/s -> {after:.0f}/s")
+        if failed:
+            sys.exit(1)
+        print("No stage regressed.")
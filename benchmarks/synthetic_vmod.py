@@ -0,0 +1,172 @@
+"""Builds a synthetic Red_Strike vmod, CloudInfo.bson and templates.zip of any size, so the pipeline can be benchmarked without the real module."""
+import io
+import os
+import random
+import struct
+import sys
+from zipfile import ZipFile, ZIP_STORED
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "unit_tags"))
+from unit_data_entry import UnitType, UnitFormation
+
+FACTIONS = ("NATO Units", "WP Units")
+COUNTER_SIZE = 150
+# where preprocess_images.py crops the NATO symbol, and the two ROIs of process.py inside that crop
+FORMATION_BOX = (90, 39)
+TYPE_BOX = (90, 51)
+
+
+def piece_slot(name, pngs):
+    return '<VASSAL.build.widget.PieceSlot entryName="{0}" gpid="0" height="0" width="0">+/null/prototype;Unit\tpiece;;;{1};{0}/\t\\\\null;0;0;0</VASSAL.build.widget.PieceSlot>'.format(name, pngs)
+
+
+def template_image(seed, height, width=41):
+    # black and white noise, distinct enough per enum value that matching is unambiguous
+    rng = np.random.default_rng(seed)
+    return (rng.integers(0, 2, (height, width, 1)) * 255).repeat(3, axis=2).astype(np.uint8)
+
+
+def formation_templates():
+    return {formation: template_image(i, 12) for i, formation in enumerate(UnitFormation)}
+
+
+def type_templates():
+    return {unit_type: template_image(100 + i, 21) for i, unit_type in enumerate(UnitType)}
+
+
+def png_bytes(pixels):
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def counter_image(background, formation, unit_type, serial):
+    # flat background, the two symbols where process.py looks for them, and a serial bar so no two counters are identical
+    counter = np.empty((COUNTER_SIZE, COUNTER_SIZE, 3), np.uint8)
+    counter[:] = background
+    x, y = FORMATION_BOX
+    counter[y:y + formation.shape[0], x:x + formation.shape[1]] = formation
+    x, y = TYPE_BOX
+    counter[y:y + unit_type.shape[0], x:x + unit_type.shape[1]] = unit_type
+    for bit in range(24):
+        if serial >> bit & 1:
+            counter[4:8, 4 + bit * 4:7 + bit * 4] = 255
+    return counter
+
+
+def synthetic_buildfile(scale=1, nations=2, commands=4, units=10, cards=20, marker_categories=4, markers=10, sub_commands=False):
+    # units per command grow with scale, sub_commands moves half of each command's units one level down
+    ## (import_tts only takes faction/nation/command/unit, so that is the default)
+    ## returns the xml and (png, kind) for every image it references
+    units = units * scale
+    sub_commands = sub_commands and units > 1
+    images = []
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="no"?><VASSAL.build.GameModule name="Red Strike">',
+             '<VASSAL.build.module.PieceWindow name="Counters"><VASSAL.build.widget.TabWidget entryName="Counters">']
+    for faction in FACTIONS:
+        parts.append('<VASSAL.build.widget.TabWidget entryName="{0}">'.format(faction))
+        for n in range(nations):
+            parts.append('<VASSAL.build.widget.TabWidget entryName="Nation {0}">'.format(n))
+            for c in range(commands):
+                parts.append('<VASSAL.build.widget.ListWidget entryName="Command {0}">'.format(c))
+                for u in range(units):
+                    if sub_commands and u == units // 2:
+                        parts.append('<VASSAL.build.widget.ListWidget entryName="Sub Command {0}">'.format(c))
+                    front = "{0}_{1}_{2}_F_{3}.png".format(faction[:2], n, c, u)
+                    back = "{0}_{1}_{2}_B_{3}.png".format(faction[:2], n, c, u)
+                    images += [(front, "counter"), (back, "back")]
+                    parts.append(piece_slot("Unit {0}".format(u), front + "," + back))
+                if sub_commands:
+                    parts.append('</VASSAL.build.widget.ListWidget>')
+                parts.append('</VASSAL.build.widget.ListWidget>')
+            parts.append('</VASSAL.build.widget.TabWidget>')
+        parts.append('</VASSAL.build.widget.TabWidget>')
+
+    parts.append('<VASSAL.build.widget.TabWidget entryName="Cards">')
+    for deck, back in (("NATO Cards", "NATO_Card_Back.png"), ("WP Cards", "WP_Card_Back.png")):
+        images.append((back, "card"))
+        parts.append('<VASSAL.build.widget.TabWidget entryName="{0}"><VASSAL.build.widget.ListWidget entryName="{0}">'.format(deck))
+        for i in range(cards):
+            front = "{0}_Card_{1}.png".format(deck[:2], i)
+            images.append((front, "card"))
+            parts.append(piece_slot("{0} {1}".format(deck, i), front))
+        parts.append('</VASSAL.build.widget.ListWidget></VASSAL.build.widget.TabWidget>')
+    parts.append('</VASSAL.build.widget.TabWidget>')
+
+    parts.append('<VASSAL.build.widget.TabWidget entryName="Markers">')
+    for c in range(marker_categories):
+        parts.append('<VASSAL.build.widget.ListWidget entryName="Markers {0}">'.format(c))
+        for i in range(markers):
+            front = "Mrk_{0}_{1}.png".format(c, i)
+            images.append((front, "marker"))
+            parts.append(piece_slot("Marker {0}".format(i), front))
+        parts.append('</VASSAL.build.widget.ListWidget>')
+    parts.append('</VASSAL.build.widget.TabWidget>')
+
+    # the real module has more than one PieceWindow, only the 0th holds the counters
+    parts.append('</VASSAL.build.widget.TabWidget></VASSAL.build.module.PieceWindow>')
+    parts.append('<VASSAL.build.module.PieceWindow name="Game Pieces"><VASSAL.build.widget.TabWidget entryName="Game Pieces"/></VASSAL.build.module.PieceWindow>')
+    parts.append('</VASSAL.build.GameModule>')
+    return "".join(parts), images
+
+
+def bson_document(fields):
+    # just the BSON types CloudInfo.bson uses: embedded documents, strings and int32
+    body = b""
+    for key, value in fields.items():
+        name = key.encode() + b"\x00"
+        if type(value) is dict:
+            body += b"\x03" + name + bson_document(value)
+        elif type(value) is int:
+            body += b"\x10" + name + struct.pack("<i", value)
+        else:
+            encoded = value.encode() + b"\x00"
+            body += b"\x02" + name + struct.pack("<i", len(encoded)) + encoded
+    return struct.pack("<i", len(body) + 5) + body + b"\x00"
+
+
+def write_templates_zip(templates_path):
+    with ZipFile(templates_path, "w", ZIP_STORED) as templates_zip:
+        for directory, templates in (("unit_formation_templates", formation_templates()), ("unit_type_templates", type_templates())):
+            for entry, pixels in templates.items():
+                templates_zip.writestr("templates/{0}/{1}/0.png".format(directory, entry.value), png_bytes(pixels))
+
+
+def build_synthetic_vmod(output_dir, scale=1, seed=0):
+    # Red_Strike_V1_2.vmod, CloudInfo.bson and templates.zip in output_dir, returns their paths
+    rng = random.Random(seed)
+    buildfile, images = synthetic_buildfile(scale)
+    formations = list(formation_templates().values())
+    unit_types = list(type_templates().values())
+
+    vmod_path = os.path.join(output_dir, "Red_Strike_V1_2.vmod")
+    with ZipFile(vmod_path, "w", ZIP_STORED) as vmod_zip:
+        vmod_zip.writestr("buildFile.xml", buildfile)
+        for serial, (png, kind) in enumerate(images):
+            if kind == "counter":
+                pixels = counter_image(rng.choice(((0, 90, 180), (200, 40, 40), (60, 120, 60))),
+                                       rng.choice(formations), rng.choice(unit_types), serial)
+            else:
+                pixels = np.full((60, 40, 3), serial % 256, np.uint8)
+            vmod_zip.writestr("images/" + png, png_bytes(pixels))
+
+    documents = {}
+    for i, (png, _) in enumerate(images):
+        documents[str(i)] = {"Name": png, "URL": "https://steamusercontent.com/ugc/{0}/".format(i), "Size": 0, "Folder": ""}
+    bson_path = os.path.join(output_dir, "CloudInfo.bson")
+    with open(bson_path, "wb") as bson_file:
+        bson_file.write(bson_document(documents))
+
+    templates_path = os.path.join(output_dir, "templates.zip")
+    write_templates_zip(templates_path)
+    return vmod_path, bson_path, templates_path
+
+
+if __name__ == "__main__":
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    output_dir = sys.argv[2] if len(sys.argv) > 2 else "."
+    for path in build_synthetic_vmod(output_dir, scale):
+        print(path)
@@ -0,0 +1,79 @@
+"""Packs the NATO/WP card faces of the vmod into TTS deck sheets (up to 10x7 cards each) for upload to Steam Cloud."""
+import io
+import json
+import math
+import os
+from zipfile import ZipFile
+
+from PIL import Image
+
+import redstrike_vassal_parse_xml as parser
+
+# TTS custom deck sheets hold at most 10 columns by 7 rows
+MAX_COLUMNS = 10
+MAX_ROWS = 7
+
+
+def sheet_name(deck_name, index):
+    return "{0}_Sheet_{1}.png".format(deck_name.replace(" ", "_"), index + 1)
+
+
+def plan_sheets(deck, columns=MAX_COLUMNS, rows=MAX_ROWS):
+    # one entry per card name, like the cards json, split into sheets of columns x rows
+    cards = [card for card in {card.name: card for card in deck.cards}.values() if card.front_png is not None]
+    per_sheet = columns * rows
+    sheets = []
+    for index, start in enumerate(range(0, len(cards), per_sheet)):
+        sheet_cards = cards[start:start + per_sheet]
+        num_width = min(columns, len(sheet_cards))
+        num_height = math.ceil(len(sheet_cards) / num_width)
+        sheets.append({
+            "sheet":        sheet_name(deck.name, index),
+            "num_width":    num_width,
+            "num_height":   num_height,
+            "cards":        [card.name for card in sheet_cards],
+            "front_pngs":   [card.front_png for card in sheet_cards]
+        })
+    return sheets
+
+
+def render_sheet(vmod_zip, sheet, image_dir="images"):
+    faces = [Image.open(io.BytesIO(vmod_zip.read("{0}/{1}".format(image_dir, png)))).convert("RGB")
+             for png in sheet["front_pngs"]]
+    # every cell gets the size of the first face, TTS stretches the sheet evenly anyway
+    cell_width, cell_height = faces[0].size
+    atlas = Image.new("RGB", (cell_width * sheet["num_width"], cell_height * sheet["num_height"]))
+    for i, face in enumerate(faces):
+        if face.size != (cell_width, cell_height):
+            face = face.resize((cell_width, cell_height), Image.LANCZOS)
+        atlas.paste(face, ((i % sheet["num_width"]) * cell_width, (i // sheet["num_width"]) * cell_height))
+    return atlas
+
+
+def build_card_atlases(vmod_path, output_dir, layout_path, columns=MAX_COLUMNS, rows=MAX_ROWS):
+    # only the card layout of buildFile.xml is needed here, the URLs come later from CloudInfo
+    _, decks, _ = parser.parse_redstrike_vmod(vmod_path, parser.CloudIndex({}))
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    layout = {}
+    with ZipFile(vmod_path, 'r') as vmod_zip:
+        for deck in decks:
+            layout[deck.name] = plan_sheets(deck, columns, rows)
+            for sheet in layout[deck.name]:
+                render_sheet(vmod_zip, sheet).save(os.path.join(output_dir, sheet["sheet"]), optimize=True)
+                print("{0}: {1} cards, {2}x{3}".format(sheet["sheet"], len(sheet["cards"]), sheet["num_width"], sheet["num_height"]))
+
+    with open(layout_path, 'w') as layout_file:
+        json.dump(layout, layout_file, indent=4)
+    return layout
+
+
+if __name__ == "__main__":
+    vmod_path = "./Red_Strike_V1_2.vmod"
+    output_dir = "./card_atlases"           # upload these to Steam Cloud next to the counter images
+    layout_path = "./card_atlases.json"     # read by redstrike_vassal_parse_xml.py once the sheets are uploaded
+
+    build_card_atlases(vmod_path, output_dir, layout_path)
+    print("DONE!")
@@ -1,39 +1,269 @@
+import hashlib
 import json
 import os
-import uuid
 
-with open('templates.json') as templateFile:
-    templateStr = templateFile.read()
+from instrumentation import recorder, span
 
-def getTemplate(name):
-    templates = json.loads(templateStr)
-    template = templates[name]
-    template['GUID'] = str(uuid.uuid4())[:6]
+class TemplateRegistry:
+    # parses templates.json once, every getTemplate hands out a copy of the prototype
+    ## only the containers that callers fill in are copied, the rest is shared
+    mutableKeys = ('CustomImage', 'CustomDeck', 'ContainedObjects', 'DeckIDs', 'Tags')
+
+    def __init__(self, path):
+        with open(path) as templateFile:
+            self.prototypes = json.load(templateFile)
+        self.digest = hashlib.sha256(json.dumps(self.prototypes, sort_keys=True).encode()).hexdigest()
+
+    def get(self, name):
+        template = dict(self.prototypes[name])
+        for key in TemplateRegistry.mutableKeys:
+            if key in template:
+                template[key] = copyJson(template[key])
+        return template
+
+def childPath(path, obj):
+    # path of obj below its container's path: the Nickname, but cards have none, their CardID tells them apart
+    if 'CardID' in obj:
+        return (*path, str(obj['CardID']))
+    return (*path, obj.get('Nickname', ''))
+
+class GuidRegistry:
+    # GUIDs derived from the path of each object (see childPath), so the same inputs give a byte-identical save
+    ## a GUID that is already taken in this save is rehashed with a counter, in build order
+    def __init__(self):
+        self.paths = {}
+        self.collisions = 0
+        self.conflicts = []
+
+    def derive(self, path):
+        key = json.dumps(path)
+        attempt = 0
+        guid = hashlib.sha256(key.encode()).hexdigest()[:6]
+        while guid in self.paths:
+            attempt += 1
+            self.collisions += 1
+            guid = hashlib.sha256(f'{key}#{attempt}'.encode()).hexdigest()[:6]
+        self.paths[guid] = key
+        return guid
+
+    def claim(self, guid, path):
+        # GUIDs that come from a previous save, False when another object of this save has it already
+        key = json.dumps(path)
+        if self.paths.setdefault(guid, key) != key:
+            self.conflicts.append((guid, key, self.paths[guid]))
+            return False
+        return True
+
+    def claimTree(self, obj, path):
+        if 'GUID' in obj:
+            self.claim(obj['GUID'], path)
+        # CustomDeck entries are derived under their deck's path, a card repeats its deck's entry
+        deckPath = path[:-1] if 'CardID' in obj else path
+        for deckID, entry in obj.get('CustomDeck', {}).items():
+            if 'GUID' in entry:
+                self.claim(entry['GUID'], (*deckPath, 'CustomDeck', deckID))
+        for child in obj.get('ObjectStates', []) + obj.get('ContainedObjects', []):
+            self.claimTree(child, childPath(path, child))
+
+    def report(self):
+        for guid, path, other in self.conflicts:
+            print(f"WARN:  GUID {guid} of {path} is also used by {other}")
+
+class SaveSplicer:
+    # incremental mode: objects of the previous save whose inputs are unchanged are reused as they are,
+    ## rebuilt objects keep the GUID the previous save had at the same Nickname path
+    ## the whole previous save stays in memory, so peak memory is no longer bounded by one formation bag
+    def __init__(self, previousSave=None, previousManifest=None, salt=''):
+        self.previous = {}
+        self.previousManifest = previousManifest or {}
+        # path key -> manifest keys below it, so a reused bag finds its subtree's entries without a scan
+        self.manifestChildren = {}
+        for childKey in self.previousManifest:
+            childPath = json.loads(childKey)
+            for depth in range(len(childPath)):
+                self.manifestChildren.setdefault(json.dumps(childPath[:depth]), []).append(childKey)
+        self.manifest = {}
+        self.salt = salt
+        self.reused = 0
+        self.rebuilt = 0
+        if previousSave is not None:
+            self.index(previousSave, ())
+
+    @staticmethod
+    def load(savePath, manifestPath, salt=''):
+        if not (os.path.exists(savePath) and os.path.exists(manifestPath)):
+            return SaveSplicer(salt=salt)
+        with open(savePath) as saveFile, open(manifestPath) as manifestFile:
+            return SaveSplicer(json.load(saveFile), json.load(manifestFile), salt)
+
+    def index(self, obj, path):
+        self.previous[json.dumps(path)] = obj
+        for child in obj.get('ObjectStates', []) + obj.get('ContainedObjects', []):
+            self.index(child, childPath(path, child))
+
+    def reuse(self, guids, path, *inputs):
+        if any(i is None for i in inputs):
+            self.rebuilt += 1
+            return None
+        key = json.dumps(path)
+        fingerprint = hashlib.sha256(json.dumps([self.salt, *inputs]).encode()).hexdigest()
+        self.manifest[key] = fingerprint
+        if self.previousManifest.get(key) == fingerprint and key in self.previous:
+            self.reused += 1
+            # the reused subtree's own entries still describe it
+            for childKey in self.manifestChildren.get(key, []):
+                self.manifest[childKey] = self.previousManifest[childKey]
+            guids.claimTree(self.previous[key], path)
+            return self.previous[key]
+        self.rebuilt += 1
+        return None
+
+    def keepGuid(self, guids, obj, path):
+        previous = self.previous.get(json.dumps(path))
+        if previous is not None and 'GUID' in previous and previous['GUID'] != obj['GUID']:
+            if guids.claim(previous['GUID'], path):
+                obj['GUID'] = previous['GUID']
+        return obj
+
+    def save(self, manifestPath):
+        with open(manifestPath, 'w') as manifestFile:
+            json.dump(self.manifest, manifestFile, indent=4)
+
+class TagIndex:
+    # unit_tags.json joined onto the tiles by front png, and the inverted index tag -> tile GUIDs
+    ## the Generated Counters bag carries, so in-game searches don't have to open every nested bag
+    ## tiles are recorded from the finished bags, built or reused, so the GUIDs are the ones in the save
+    def __init__(self, unitTags=None):
+        self.unitTags = {}
+        for entry in unitTags or []:
+            self.unitTags[entry['filename']] = [str(entry[key]) for key in ('unit_type', 'unit_formation') if entry[key] is not None]
+        self.tags = {}
+        self.paths = {}
+
+    def tileTags(self, data):
+        return self.unitTags.get(data.get('front_png'), [])
+
+    def unitsTags(self, units):
+        # reuse input of a formation bag, a changed tag rebuilds the bag
+        return {unit: self.tileTags(data) for unit, data in units.items()}
+
+    def add(self, obj, path):
+        # path: Nicknames down to obj, every tile below it is indexed with the bags that hold it
+        if obj.get('Name') == 'Custom_Tile':
+            for tag in obj.get('Tags', []):
+                self.tags.setdefault(tag, []).append(obj['GUID'])
+            self.paths[obj['GUID']] = list(path[len(counterRoot):-1])
+            return
+        for child in obj.get('ContainedObjects', []):
+            self.add(child, (*path, child.get('Nickname', '')))
+
+    def state(self):
+        # LuaScriptState of the Generated Counters bag, only complete once the counter boxes are built
+        return json.dumps({'tags': self.tags, 'paths': self.paths}, separators=(',', ':'))
+
+# bag.call('findUnits', {'Pact', 'ARMOR', 'DIVISION'}) returns {GUID = bag path} of the tiles carrying all the tags
+tagIndexScript = '''function onLoad(savedState)
+    state = savedState
+    index = JSON.decode(savedState)
+end
+
+function onSave()
+    return state
+end
+
+function findUnits(tags)
+    local found = {}
+    for i, tag in ipairs(tags) do
+        local matches = {}
+        for _, guid in ipairs(index.tags[tag] or {}) do
+            if i == 1 or found[guid] then
+                matches[guid] = index.paths[guid]
+            end
+        end
+        found = matches
+    end
+    return found
+end'''
+
+def copyJson(value):
+    if type(value) is dict:
+        return {k: copyJson(v) for k, v in value.items()}
+    if type(value) is list:
+        return [copyJson(v) for v in value]
+    return value
+
+templates = TemplateRegistry(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates.json'))
+counterRoot = ('Generated Counters',)
+
+def getTemplate(name, path, guids):
+    # path: Nicknames from the save root down to this object, the GUID is derived from it
+    ## guids: the GuidRegistry of the save being built
+    template = templates.get(name)
+    template['GUID'] = guids.derive(path)
     return template
 
-def createCardEntry(data):
-    card = getTemplate('cardEntry')
+def createCardEntry(data, path, guids):
+    card = getTemplate('cardEntry', path, guids)
     card['FaceURL'] = data['front_png_url']
     card['BackURL'] = data['back_png_url']
     return dict(card)
 
-def createCard(cardID, cardEntry):
-    card= getTemplate('card')
+def createCard(cardID, cardEntry, path, guids):
+    # path: the deck's, see childPath
+    card= getTemplate('card', (*path, str(int(cardID)*101)), guids)
     card['CardID'] = int(cardID)*101
     card['CustomDeck'] = {cardID:cardEntry}
     return card
     
-def createDeck(data, name):
-    deck = getTemplate('deck')
-    deck['CustomDeck'] = {str(i+1):createCardEntry(data[cardEntry]) for i,cardEntry in enumerate(data)}
-    deck['DeckIDs'] = [int(k) * 101 for k in deck['CustomDeck'].keys()]
+def createSheetEntry(sheet, backURL, path, guids):
+    card = getTemplate('cardEntry', path, guids)
+    card['FaceURL'] = sheet['face_url']
+    card['BackURL'] = backURL
+    card['NumWidth'] = sheet['num_width']
+    card['NumHeight'] = sheet['num_height']
+    return dict(card)
+
+def createSheetCard(sheetID, index, sheetEntry, path, guids):
+    # cards of a sheet are numbered row by row, CardID = sheet id * 100 + position on the sheet
+    ## path: the deck's, see childPath
+    card = getTemplate('card', (*path, str(int(sheetID)*100 + index)), guids)
+    card['CardID'] = int(sheetID)*100 + index
+    card['CustomDeck'] = {sheetID:sheetEntry}
+    return card
+
+def createDeck(data, name, guids, splicer=None, fingerprint=None, atlas=None):
+    # atlas: the deck's entry of the parser's card atlases json, cards left out of it keep one image per card
+    path = (*counterRoot, name)
+    if splicer is not None:
+        previous = splicer.reuse(guids, path, fingerprint, atlas or {})
+        if previous is not None:
+            return previous
+    deck = getTemplate('deck', path, guids)
+    deck['CustomDeck'] = {}
+    deck['ContainedObjects'] = []
+    onSheet = {}
+    for sheet in (atlas or {}).get('sheets', []):
+        sheetID = str(len(deck['CustomDeck'])+1)
+        deck['CustomDeck'][sheetID] = createSheetEntry(sheet, atlas['back_url'], (*path, 'CustomDeck', sheetID), guids)
+        for index, cardName in enumerate(sheet['cards']):
+            if cardName in data:
+                onSheet[cardName] = createSheetCard(sheetID, index, deck['CustomDeck'][sheetID], path, guids)
+    for cardEntry in data:
+        if cardEntry in onSheet:
+            deck['ContainedObjects'].append(onSheet[cardEntry])
+        else:
+            cardID = str(len(deck['CustomDeck'])+1)
+            deck['CustomDeck'][cardID] = createCardEntry(data[cardEntry], (*path, 'CustomDeck', cardID), guids)
+            deck['ContainedObjects'].append(createCard(cardID, deck['CustomDeck'][cardID], path, guids))
+    deck['DeckIDs'] = [card['CardID'] for card in deck['ContainedObjects']]
     deck['Nickname'] = name
-    deck['ContainedObjects'] = [createCard(cardId, entry) for cardId, entry in deck['CustomDeck'].items()]
+    if splicer is not None:
+        splicer.keepGuid(guids, deck, path)
     return deck
     
-def createTile(name, data, faction, tags):
-    tile = getTemplate('tile')
-    tile['Tags'] = tags
+def createTile(name, data, faction, tags, path, guids, tagIndex=None):
+    tile = getTemplate('tile', path, guids)
+    tile['Tags'] = [*tags, *tagIndex.tileTags(data)] if tagIndex is not None else tags
     tile['CustomImage']['ImageURL'] = data['front_png_url']
     if data['back_png_url'] == "":
         tile['CustomImage']['ImageSecondaryURL'] = tile['CustomImage']['ImageURL']
@@ -42,40 +272,193 @@ def createTile(name, data, faction, tags):
     tile['Nickname'] = name
     return tile
     
-def createCounterBox(data, faction, name):
-    bag = getTemplate('bag')
-    bag['Nickname'] = name
+def createFormationBag(formation, units, faction, countrytags, guids, splicer=None, fingerprint=None, path=(), tagIndex=None):
+    formationTags = [*countrytags, formation]
+    if splicer is not None:
+        previous = splicer.reuse(guids, path, fingerprint, formationTags, tagIndex.unitsTags(units) if tagIndex is not None else {})
+        if previous is not None:
+            if tagIndex is not None:
+                tagIndex.add(previous, path)
+            return previous
+    formationBag = getTemplate('bag', path, guids)
+    formationBag['Nickname'] = formation
+    formationBag['Tags'] = formationTags
+    formationBag['ContainedObjects'] = [createTile(unit, units[unit], faction, formationTags, (*path, unit), guids, tagIndex) for unit in units ]
+    if splicer is not None:
+        splicer.keepGuid(guids, formationBag, path)
+        for tile in formationBag['ContainedObjects']:
+            splicer.keepGuid(guids, tile, (*path, tile['Nickname']))
+    if tagIndex is not None:
+        tagIndex.add(formationBag, path)
+    return formationBag
+
+def createCountryBag(country, formations, faction, tags, guids, lazy=False, splicer=None, fingerprints=None, path=(), tagIndex=None):
+    countrytags =[*tags, country]
+    fingerprints = fingerprints or {}
+    if splicer is not None:
+        unitsTags = {formation: tagIndex.unitsTags(units) for formation, units in formations.items()} if tagIndex is not None else {}
+        previous = splicer.reuse(guids, path, fingerprints.get('fingerprint'), countrytags, unitsTags)
+        if previous is not None:
+            if tagIndex is not None:
+                tagIndex.add(previous, path)
+            return previous
+    countryBag = getTemplate('bag', path, guids)
+    countryBag['Nickname'] = country;
+    countryBag['Tags'] = countrytags
+    if splicer is not None:
+        splicer.keepGuid(guids, countryBag, path)
+    formationFingerprints = fingerprints.get('commands', {})
+    formationBags = (createFormationBag(formation, units, faction, countrytags, guids, splicer,
+                                        formationFingerprints.get(formation), (*path, formation), tagIndex)
+                     for formation, units in formations.items())
+    countryBag['ContainedObjects'] = formationBags if lazy else list(formationBags)
+    return countryBag
+
+def createCounterBox(data, faction, name, guids, lazy=False, splicer=None, fingerprints=None, tagIndex=None):
+    # lazy: ContainedObjects are generators, formation bags are only built while dumpSave writes them
+    ## splicer/fingerprints: incremental mode, fingerprints is this faction's part of the parser's *_fingerprints.json
+    ## tagIndex: adds the unit_tags.json tags to the tiles and records them in the index
     tags = [faction]
+    fingerprints = fingerprints or {}
+    path = (*counterRoot, name)
+    if splicer is not None:
+        unitsTags = {country: {formation: tagIndex.unitsTags(units) for formation, units in formations.items()}
+                     for country, formations in data.items()} if tagIndex is not None else {}
+        previous = splicer.reuse(guids, path, fingerprints.get('fingerprint'), tags, unitsTags)
+        if previous is not None:
+            if tagIndex is not None:
+                tagIndex.add(previous, path)
+            return previous
+    bag = getTemplate('bag', path, guids)
+    bag['Nickname'] = name
     bag['Tags'] = tags
-    for country, formations in data.items():
-        countrytags =[*tags, country]
-        countryBag = getTemplate('bag')
-        countryBag['Nickname'] = country;
-        countryBag['Tags'] = countrytags
-        for formation, units in formations.items():
-            formationTags = [*countrytags, formation]
-            formationBag = getTemplate('bag')
-            formationBag['Nickname'] = formation
-            formationBag['Tags'] = formationTags
-            formationBag['ContainedObjects'] = [createTile(unit, units[unit], faction, formationTags) for unit in units ]
-            countryBag['ContainedObjects'].append(formationBag)
-        bag['ContainedObjects'].append(countryBag)
+    if splicer is not None:
+        splicer.keepGuid(guids, bag, path)
+    nationFingerprints = fingerprints.get('nations', {})
+    countryBags = (createCountryBag(country, formations, faction, tags, guids, lazy, splicer,
+                                    nationFingerprints.get(country), (*path, country), tagIndex)
+                   for country, formations in data.items())
+    bag['ContainedObjects'] = countryBags if lazy else list(countryBags)
     return bag
 
-with open('Red_Strike_V1_2.vmod_factions.json') as factionsFile, open('Red_Strike_V1_2.vmod_cards.json') as cardsFile:
-    factionsData =json.loads(factionsFile.read())
-    cardsData =json.loads(cardsFile.read())
-    
-counterBag = getTemplate('bag')
-counterBag['Nickname'] = 'Generated Counters'
-counterBag['ContainedObjects'] = [
-    createCounterBox(factionsData['NATO Units'],'NATO','NATO'), 
-    createCounterBox(factionsData['WP Units'],'Pact','WP'),
-    createDeck(cardsData['NATO Cards'],'NATO Cards'),
-    createDeck(cardsData['WP Cards'],'Pact Cards')]
-
-ttsSave = getTemplate('ttsSave')
-ttsSave['ObjectStates'] = [counterBag]
-with open('RS89_Tokens.json','w') as counterFile:
-    json.dump(ttsSave,counterFile, indent=4)
-    
\ No newline at end of file
+def iterJson(obj, indent, level=0):
+    # json.dump compatible output, but ObjectStates/ContainedObjects are walked (and consumed) one object at a time
+    ## callable values are called when they are reached, after everything written before them
+    if indent is None:
+        itemSeparator, keySeparator, newline, childNewline = ',', ':', '', ''
+    else:
+        itemSeparator, keySeparator = ',', ': '
+        newline = '\n' + ' ' * (indent * level)
+        childNewline = '\n' + ' ' * (indent * (level + 1))
+
+    yield '{'
+    first = True
+    for key, value in obj.items():
+        yield ('' if first else itemSeparator) + childNewline + json.dumps(key) + keySeparator
+        first = False
+        if key in ('ObjectStates', 'ContainedObjects'):
+            yield '['
+            empty = True
+            for child in value:
+                yield ('' if empty else itemSeparator) + ('' if indent is None else '\n' + ' ' * (indent * (level + 2)))
+                empty = False
+                yield from iterJson(child, indent, level + 2)
+            yield ']' if empty else childNewline + ']'
+            continue
+        if callable(value):
+            value = value()
+        if indent is None:
+            yield json.dumps(value, separators=(itemSeparator, keySeparator))
+        else:
+            yield json.dumps(value, indent=indent).replace('\n', childNewline)
+    yield '}' if first else newline + '}'
+
+def dumpSave(ttsSave, saveFile, compact=False):
+    for chunk in iterJson(ttsSave, None if compact else 4):
+        saveFile.write(chunk)
+
+def buildSave(factionsData, cardsData, fingerprintsData=None, atlasesData=None, splicer=None, unitTags=None, guids=None):
+    # the whole RS89_Tokens save from the parser's factions/cards data, counter boxes are lazy (see createCounterBox)
+    ## unitTags: the unit_tags.json list, tags the tiles and puts the TagIndex on the Generated Counters bag
+    ## guids: the save's GuidRegistry, pass one in to hand it to exportSave, the lazy boxes fill it while they are dumped
+    guids = guids if guids is not None else GuidRegistry()
+    fingerprintsData = fingerprintsData or {'factions': {}, 'decks': {}}
+    atlasesData = atlasesData or {}
+    tagIndex = TagIndex(unitTags) if unitTags is not None else None
+    counterBag = getTemplate('bag', counterRoot, guids)
+    counterBag['Nickname'] = 'Generated Counters'
+    if tagIndex is not None:
+        counterBag['LuaScript'] = tagIndexScript
+        # moved behind ContainedObjects, the index is complete once dumpSave has built the lazy counter boxes
+        del counterBag['LuaScriptState']
+    counterBag['ContainedObjects'] = [
+        createCounterBox(factionsData['NATO Units'],'NATO','NATO', guids, lazy=True,
+                         splicer=splicer, fingerprints=fingerprintsData['factions'].get('NATO Units'), tagIndex=tagIndex), 
+        createCounterBox(factionsData['WP Units'],'Pact','WP', guids, lazy=True,
+                         splicer=splicer, fingerprints=fingerprintsData['factions'].get('WP Units'), tagIndex=tagIndex),
+        createDeck(cardsData['NATO Cards'],'NATO Cards', guids, splicer, fingerprintsData['decks'].get('NATO Cards'),
+                   atlasesData.get('NATO Cards')),
+        createDeck(cardsData['WP Cards'],'Pact Cards', guids, splicer, fingerprintsData['decks'].get('WP Cards'),
+                   atlasesData.get('WP Cards'))]
+    if tagIndex is not None:
+        counterBag['LuaScriptState'] = tagIndex.state
+
+    ttsSave = getTemplate('ttsSave', (), guids)
+    ttsSave['ObjectStates'] = [counterBag]
+    if splicer is not None:
+        splicer.keepGuid(guids, ttsSave, ())
+        splicer.keepGuid(guids, counterBag, counterRoot)
+    return ttsSave
+
+def exportSave(ttsSave, savePath, compact=False, splicer=None, manifestPath=None, guids=None):
+    # the counter boxes are lazy, so this also covers building them
+    ## guids: the registry buildSave was given, reported once everything is built
+    with open(savePath,'w') as counterFile, span("json dump") as stage:
+        dumpSave(ttsSave, counterFile, compact)
+        stage.items = len(guids.paths) if guids is not None else None
+    if guids is not None:
+        guids.report()
+        print(f"{len(guids.paths)} GUIDs, {guids.collisions} rehashed after a collision.")
+
+    if splicer is not None:
+        splicer.save(manifestPath)
+        print(f"Reused {splicer.reused} objects, rebuilt {splicer.rebuilt}.")
+
+if __name__ == "__main__":
+    compact = False     # True drops indentation, TTS loads either
+    incremental = False # reuse the unchanged bags of the previous RS89_Tokens.json, needs the parser's fingerprints
+                        ## and loads the whole previous save, so memory grows with the save instead of one formation bag
+    fingerprintsPath = 'Red_Strike_V1_2.vmod_fingerprints.json'
+    manifestPath = 'RS89_Tokens.manifest.json'
+    atlasesPath = 'Red_Strike_V1_2.vmod_card_atlases.json'  # written by the parser once card_atlas.py sheets are uploaded
+    unitTagsPath = 'unit_tags/unit_tags.json'   # written by unit_tags/process.py, tags the tiles and indexes them by tag
+    instrument = False  # stage timings to RS89_Tokens.report.json
+    profileDir = None   # e.g. './profiles', one cProfile dump per stage
+    recorder.configure(instrument, profile_dir=profileDir)
+    with span("json load"), open('Red_Strike_V1_2.vmod_factions.json') as factionsFile, open('Red_Strike_V1_2.vmod_cards.json') as cardsFile:
+        factionsData =json.loads(factionsFile.read())
+        cardsData =json.loads(cardsFile.read())
+
+    atlasesData = {}
+    if os.path.exists(atlasesPath):
+        with open(atlasesPath) as atlasesFile:
+            atlasesData = json.load(atlasesFile)
+
+    unitTags = None
+    if os.path.exists(unitTagsPath):
+        with open(unitTagsPath) as unitTagsFile:
+            unitTags = json.load(unitTagsFile)
+
+    splicer = None
+    fingerprintsData = None
+    if incremental and os.path.exists(fingerprintsPath):
+        with open(fingerprintsPath) as fingerprintsFile:
+            fingerprintsData = json.load(fingerprintsFile)
+        splicer = SaveSplicer.load('RS89_Tokens.json', manifestPath, templates.digest)
+
+    guids = GuidRegistry()
+    with span("build save"):
+        ttsSave = buildSave(factionsData, cardsData, fingerprintsData, atlasesData, splicer, unitTags, guids)
+    exportSave(ttsSave, 'RS89_Tokens.json', compact, splicer, manifestPath, guids)
+    if instrument:
+        recorder.report('RS89_Tokens.report.json')
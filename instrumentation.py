@@ -0,0 +1,109 @@
+"""Wall time, CPU time, memory and item counts per pipeline stage, written as a json report to compare runs across vmod versions."""
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource     # not on Windows, peak RSS is left out there
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    # bytes, ru_maxrss is in kilobytes on Linux and bytes on macOS
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+
+class Span:
+    __slots__ = ("name", "items", "wall", "cpu", "peak_traced", "peak_rss")
+
+    def __init__(self, name, items=None):
+        self.name = name
+        self.items = items      # set by the stage, e.g. the number of units parsed
+        self.wall = None
+        self.cpu = None
+        self.peak_traced = None
+        self.peak_rss = None
+
+    def as_dict(self):
+        return {
+            "name":         self.name,
+            "items":        self.items,
+            "wall_s":       self.wall,
+            "cpu_s":        self.cpu,
+            "peak_traced":  self.peak_traced,
+            "peak_rss":     self.peak_rss
+        }
+
+
+class Recorder:
+    # spans nest, a nested span is reported as "outer/inner"
+    ## tracemalloc and cProfile are opt-in, both slow the stages down noticeably
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.profile_dir = None
+        self.spans = []
+        self.stack = []
+
+    def configure(self, enabled=True, trace_memory=False, profile_dir=None):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if profile_dir is not None and not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+
+    def _flush_peak(self):
+        # tracemalloc has one peak, hand it to every open span before it gets reset
+        peak = tracemalloc.get_traced_memory()[1]
+        for open_span in self.stack:
+            open_span.peak_traced = max(open_span.peak_traced or 0, peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def span(self, name, items=None):
+        if not self.enabled:
+            yield Span(name, items)
+            return
+
+        current = Span(self.stack[-1].name + "/" + name if self.stack else name, items)
+        if self.trace_memory:
+            self._flush_peak()
+        self.stack.append(current)
+        self.spans.append(current)
+        # only one profiler can run at a time, so only outermost spans get a profile
+        profiler = cProfile.Profile() if self.profile_dir is not None and len(self.stack) == 1 else None
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield current
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            current.wall = time.perf_counter() - wall_start
+            current.cpu = time.process_time() - cpu_start
+            if self.trace_memory:
+                self._flush_peak()
+            current.peak_rss = peak_rss()
+            self.stack.pop()
+            if profiler is not None:
+                profiler.dump_stats(os.path.join(self.profile_dir, "{0}.prof".format(current.name.replace(" ", "_"))))
+
+    def report(self, json_path):
+        # spans in the order they started
+        with open(json_path, 'w') as json_file:
+            json.dump({"spans": [s.as_dict() for s in self.spans]}, json_file, indent=4)
+
+
+recorder = Recorder()
+span = recorder.span
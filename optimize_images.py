@@ -0,0 +1,122 @@
+"""Shrinks the counter, marker and card pngs of the vmod into an upload folder for Steam Cloud, and records the bytes saved."""
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import ZipFile
+
+from PIL import Image
+
+_worker_zip = None
+
+
+def drop_unused_alpha(image, steps):
+    if image.mode in ("RGBA", "LA") and image.getchannel("A").getextrema() == (255, 255):
+        image = image.convert(image.mode[:-1])
+        steps.append("alpha")
+    return image
+
+
+def quantize_palette(image, steps):
+    # only when the counter already has few enough colors for a palette, checked pixel for pixel so it stays lossless
+    if image.mode not in ("RGB", "RGBA") or image.getcolors(256) is None:
+        return image
+    quantized = image.quantize(colors=256, method=Image.Quantize.FASTOCTREE if image.mode == "RGBA" else Image.Quantize.MEDIANCUT)
+    if quantized.convert(image.mode).tobytes() != image.tobytes():
+        return image
+    steps.append("palette")
+    return quantized
+
+
+def downscale(image, max_size, steps):
+    if max_size is None or (image.width <= max_size[0] and image.height <= max_size[1]):
+        return image
+    image = image.copy()
+    image.thumbnail(max_size, Image.LANCZOS)
+    steps.append("downscale")
+    return image
+
+
+def optimize_png(data, max_size=None):
+    # returns the new png bytes and the steps that were applied, or the original bytes when nothing got smaller
+    steps = []
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        image = downscale(image, max_size, steps)
+        image = drop_unused_alpha(image, steps)
+        image = quantize_palette(image, steps)
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG", optimize=True)
+    optimized = buffer.getvalue()
+    if len(optimized) >= len(data) and "downscale" not in steps:
+        return data, []
+    return optimized, steps + ["recompress"]
+
+
+def _init_worker(vmod_path):
+    global _worker_zip
+    _worker_zip = ZipFile(vmod_path, 'r')
+
+
+def _optimize_chunk(args):
+    names, image_dir, output_dir, max_size = args
+    results = []
+    for name in names:
+        data = _worker_zip.read("{0}/{1}".format(image_dir, name))
+        optimized = data
+        steps = []
+        if name.lower().endswith(".png"):
+            optimized, steps = optimize_png(data, max_size)
+        with open(os.path.join(output_dir, name), 'wb') as image_file:
+            image_file.write(optimized)
+        results.append((name, len(data), len(optimized), steps))
+    return results
+
+
+def optimize_vmod_images(vmod_path, output_dir, manifest_path, max_size=None, workers=None, chunk_size=64, image_dir="images"):
+    # files keep their names so CloudInfo keeps matching them after the upload
+    with ZipFile(vmod_path, 'r') as vmod_zip:
+        names = [member[len(image_dir) + 1:] for member in vmod_zip.namelist()
+                 if member.startswith(image_dir + "/") and not member.endswith("/")]
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    chunks = [(names[i:i + chunk_size], image_dir, output_dir, max_size) for i in range(0, len(names), chunk_size)]
+    files = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(vmod_path,)) as executor:
+        for chunk_results in executor.map(_optimize_chunk, chunks):
+            for name, original, optimized, steps in chunk_results:
+                files[name] = {
+                    "original_bytes":   original,
+                    "optimized_bytes":  optimized,
+                    "saved_bytes":      original - optimized,
+                    "steps":            steps
+                }
+
+    original_total = sum(entry["original_bytes"] for entry in files.values())
+    optimized_total = sum(entry["optimized_bytes"] for entry in files.values())
+    manifest = {
+        "total": {
+            "files":            len(files),
+            "original_bytes":   original_total,
+            "optimized_bytes":  optimized_total,
+            "saved_bytes":      original_total - optimized_total
+        },
+        "files": files
+    }
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    return manifest
+
+
+if __name__ == "__main__":
+    vmod_path = "./Red_Strike_V1_2.vmod"
+    output_dir = "./upload"                     # upload these to Steam Cloud instead of the vmod's images
+    manifest_path = "./upload_manifest.json"
+    max_size = None     # e.g. (256, 256) to downscale counters larger than the tile resolution
+    workers = os.cpu_count()
+
+    total = optimize_vmod_images(vmod_path, output_dir, manifest_path, max_size, workers)["total"]
+    print("{0} images, {1} -> {2} bytes, saved {3}".format(total["files"], total["original_bytes"], total["optimized_bytes"], total["saved_bytes"]))
+    print("DONE!")
@@ -0,0 +1,130 @@
+"""Runs parse -> tag -> TTS export in one process, the stages hand their data to each other in memory."""
+import io
+import json
+import os
+import sys
+import zipfile
+
+import import_tts
+import redstrike_vassal_parse_xml as parser
+from instrumentation import recorder, span
+
+UNIT_TAGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "unit_tags")
+if __name__ == "__main__":
+    # the unit_tags modules import each other by plain name, scripts importing this module put the directory on sys.path
+    sys.path.insert(0, UNIT_TAGS_DIR)
+
+from classification_cache import ClassificationCache
+from image_source import ZipImageSource
+from preprocess_images import crop_and_convert_images
+from unit_data_entry import SpecialCases
+import process
+
+
+def parse_stage(vmod_path, bson_path, dedupe_images=True, card_atlases_layout_path=None, workers=1):
+    # what redstrike_vassal_parse_xml.py publishes as jsons, keyed by the json's suffix
+    factions, decks, markers, cloud_index = parser.parse_vmod_data(vmod_path, bson_path, dedupe_images, workers,
+                                                                   image_hash_cache_path="{0}_image_hashes.json".format(vmod_path))
+
+    card_atlases = {}
+    if card_atlases_layout_path is not None and os.path.exists(card_atlases_layout_path):
+        card_atlases = parser.card_atlases_data(decks, card_atlases_layout_path, cloud_index)
+    cloud_index.report()
+
+    return {
+        "factions":     parser.hierarchy_data(factions),
+        "cards":        parser.decks_data(decks),
+        "markers":      parser.markers_data(markers),
+        "fingerprints": parser.fingerprints_data(factions, decks, markers),
+        "card_atlases": card_atlases
+    }
+
+
+def crop_stage(vmod_path):
+    # input_images.zip of preprocess_images.py, kept in memory, stored since it never touches the disk
+    images = io.BytesIO()
+    with ZipImageSource(vmod_path, "images") as image_source:
+        with zipfile.ZipFile(images, "w", zipfile.ZIP_STORED) as dst_zip:
+            crop_and_convert_images(image_source, dst_zip)
+    images.seek(0)
+    return images
+
+
+def tag_stage(images, templates_zip, workers, cache, purged_path):
+    entries_raw = process.classify_units(images, templates_zip, workers, cache)
+    print(f"Classification cache: {cache.hits} hits, {cache.misses} misses.")
+    entries_raw += SpecialCases
+    entries = {entry.filename: entry.__dict__ for entry in entries_raw}
+    unit_tags = process.filter_unit_tags(entries, purged_path)
+    process.check_unit_tags(unit_tags)
+    return entries, unit_tags
+
+
+def export_stage(parsed, unit_tags, save_path, manifest_path, compact=False, incremental=False):
+    # incremental: see import_tts.SaveSplicer, holds the whole previous save in memory
+    splicer = None
+    fingerprints = None
+    if incremental:
+        fingerprints = parsed["fingerprints"]
+        splicer = import_tts.SaveSplicer.load(save_path, manifest_path, import_tts.templates.digest)
+    # a registry per export, so running the pipeline again in this process gives the same save
+    guids = import_tts.GuidRegistry()
+    tts_save = import_tts.buildSave(parsed["factions"], parsed["cards"], fingerprints, parsed["card_atlases"], splicer, unit_tags, guids)
+    import_tts.exportSave(tts_save, save_path, compact, splicer, manifest_path, guids)
+
+
+def write_json(data, json_path):
+    with open(json_path, 'w') as json_file:
+        json.dump(data, json_file, indent=4)
+
+
+def run_pipeline(vmod_path, bson_path, save_path, templates_zip, cache_path, workers=None,
+                 incremental=False, compact=False, debug=False, unit_tags_dir=UNIT_TAGS_DIR):
+    # files go where the standalone scripts keep them: card_atlases.json and the parser's jsons next to the vmod,
+    ## purged.csv and, with debug, input_images.zip, output.json and unit_tags.json in unit_tags_dir
+    vmod_dir = os.path.dirname(vmod_path)
+    with span("parse"):
+        parsed = parse_stage(vmod_path, bson_path, card_atlases_layout_path=os.path.join(vmod_dir, "card_atlases.json"),
+                             workers=workers)
+    if debug:
+        for suffix, data in parsed.items():
+            write_json(data, "{0}_{1}.json".format(vmod_path, suffix))
+
+    with span("crop"):
+        images = crop_stage(vmod_path)
+    if debug:
+        with open(os.path.join(unit_tags_dir, "input_images.zip"), "wb") as images_file:
+            images_file.write(images.getvalue())
+
+    cache = ClassificationCache(cache_path)
+    with span("tag") as stage:
+        entries, unit_tags = tag_stage(images, templates_zip, workers, cache, os.path.join(unit_tags_dir, "purged.csv"))
+        stage.items = len(entries)
+    cache.save()
+    if debug:
+        write_json(entries, os.path.join(unit_tags_dir, "output.json"))
+        write_json(unit_tags, os.path.join(unit_tags_dir, "unit_tags.json"))
+
+    manifest_path = "{0}.manifest.json".format(os.path.splitext(save_path)[0])
+    with span("export"):
+        export_stage(parsed, unit_tags, save_path, manifest_path, compact, incremental)
+    return parsed, unit_tags
+
+
+if __name__ == "__main__":
+    vmod_path = "./Red_Strike_V1_2.vmod"
+    bson_path = "./CloudInfo.bson"
+    save_path = "./RS89_Tokens.json"
+    templates_zip = os.path.join(UNIT_TAGS_DIR, "templates.zip")
+    cache_path = os.path.join(UNIT_TAGS_DIR, "classification_cache.json")
+    workers = os.cpu_count()    # 1 parses and classifies in this process
+    incremental = False         # True reuses unchanged bags of the previous save, which it loads whole into memory
+    debug = False               # True also writes the intermediate jsons and input_images.zip, where the standalone scripts read them
+    instrument = False          # stage timings to pipeline_report.json
+    profile_dir = None          # e.g. "./profiles", one cProfile dump per stage
+    recorder.configure(instrument, profile_dir=profile_dir)
+
+    run_pipeline(vmod_path, bson_path, save_path, templates_zip, cache_path, workers, incremental, debug=debug)
+    if instrument:
+        recorder.report("pipeline_report.json")
+    print("DONE!")
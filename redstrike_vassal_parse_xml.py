@@ -1,244 +1,370 @@
 import os, shutil
+from concurrent.futures import ProcessPoolExecutor
 from zipfile import ZipFile
+import hashlib
+import io
 import json
+import mmap
+import struct
+from typing import NamedTuple
+from PIL import Image
 import xmltodict
-import bson
 
-class Unit:
-    def __init__(self, parent, xml_data, bson_data=None):
-        self.parent = parent
-        self.xml_data = xml_data
+from instrumentation import recorder, span
+
+class CloudIndex:
+    # Name -> URL lookup built once from the CloudInfo.bson documents
+    def __init__(self, bson_data):
+        self.urls = {}
+        self.collisions = {}
+        self.missing = set()
+        self.canonical = {}
+        self.requested = set()
+        self.build_index(bson_data)
+
+    @staticmethod
+    def from_urls(urls):
+        # a worker process' copy, built from the table of resolved_urls
+        cloud_index = CloudIndex({})
+        cloud_index.urls = urls
+        return cloud_index
+
+    def resolved_urls(self):
+        # Name -> URL after dedupe, the compact table worker processes get
+        return {png: self.canonical.get(png, url) for png, url in self.urls.items()}
+
+    def build_index(self, bson_data):
+        for _, file_details in bson_data.items():
+            name = file_details["Name"]
+            url = file_details["URL"]
+
+            if name not in self.urls:
+                self.urls[name] = url
+            elif self.urls[name] != url:
+                # first upload wins, remember the others for the report
+                self.collisions.setdefault(name, [self.urls[name]]).append(url)
+
+    def lookup(self, png):
+        if png is None:
+            return None
+
+        self.requested.add(png)
+        url = self.canonical.get(png, self.urls.get(png))
+        if url is None:
+            self.missing.add(png)
+        return url
+
+    def dedupe(self, content_hashes):
+        # pngs with the same pixels all resolve to the URL of the first name in sorted order,
+        ## so TTS downloads and caches that image once
+        first_url = {}
+        for png in sorted(content_hashes):
+            if png in self.urls:
+                url = first_url.setdefault(content_hashes[png], self.urls[png])
+                if url != self.urls[png]:
+                    self.canonical[png] = url
+
+    def report(self):
+        for name, urls in sorted(self.collisions.items()):
+            print("WARN:  {0} uploaded {1} times, using {2}".format(name, len(urls), urls[0]))
+        for name in sorted(self.missing):
+            print("WARN:  {0} not found in CloudInfo".format(name))
+        if self.canonical:
+            uploaded = {self.urls[png] for png in self.requested if png in self.urls}
+            used = {self.canonical.get(png, self.urls[png]) for png in self.requested if png in self.urls}
+            print("{0} image URLs referenced, {1} after content dedup, {2} downloads saved".format(len(uploaded), len(used), len(uploaded) - len(used)))
+
+
+class ImageHashCache:
+    # zip member -> [CRC, size, pixel hash] from earlier runs, so unchanged pngs are not decoded again
+    ## keyed by member name, a member whose CRC or size changed is decoded again
+    ## members that are not asked for during a run are dropped on save
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+
+    def lookup(self, info):
+        entry = self.entries.get(info.filename)
+        if entry is not None and entry[0] == info.CRC and entry[1] == info.file_size:
+            self.hits += 1
+            self.used[info.filename] = entry
+            return entry[2]
+        self.misses += 1
+        return None
+
+    def store(self, info, pixel_hash):
+        self.used[info.filename] = [info.CRC, info.file_size, pixel_hash]
+
+    def save(self):
+        if self.path is not None:
+            with open(self.path, 'w') as f:
+                json.dump(self.used, f)
+
+
+def image_content_hashes(vmod_path, pngs, image_dir="images", cache=None):
+    # sha256 of the decoded pixels, so a counter saved twice with different png settings still matches
+    ## byte-identical zip entries (same sha256 of the file) are decoded once, cache: an ImageHashCache
+    hashes = {}
+    by_entry = {}
+    with ZipFile(vmod_path, 'r') as vmod_zip:
+        for png in pngs:
+            try:
+                info = vmod_zip.getinfo("{0}/{1}".format(image_dir, png))
+            except KeyError:
+                continue
+            cached = cache.lookup(info) if cache is not None else None
+            if cached is not None:
+                hashes[png] = cached
+                continue
+            raw = vmod_zip.read(info)
+            entry_key = hashlib.sha256(raw).digest()
+            if entry_key not in by_entry:
+                with Image.open(io.BytesIO(raw)) as image:
+                    image = image.convert("RGBA")
+                    digest = hashlib.sha256(repr(image.size).encode())
+                    digest.update(image.tobytes())
+                by_entry[entry_key] = digest.hexdigest()
+            hashes[png] = by_entry[entry_key]
+            if cache is not None:
+                cache.store(info, hashes[png])
+    return hashes
+
+
+def as_list(xml_value):
+    # xmltodict gives a dict for a single child element and a list for several
+    if xml_value is None:
+        return []
+    if type(xml_value) is list:
+        return xml_value
+    return [xml_value]
+
+
+def fingerprint_node(xml_data, child_keys, parts):
+    # changes when the buildFile.xml subtree or any CloudInfo entry its units resolved to changes
+    ## merkle style: the node's own XML without its child widgets, then one part per child in order
+    own_xml = {key: value for key, value in xml_data.items() if key not in child_keys}
+    digest = hashlib.sha256(repr(own_xml).encode())
+    for part in parts:
+        digest.update(part.encode())
+    return digest.hexdigest()
+
+
+def record_part(xml_data, record):
+    # repr of xmltodict output is in document order, good enough to detect changes and much cheaper than json
+    return repr((xml_data, tuple(record)))
+
+
+def parse_entry_name(xml_data, replacement=" "):
+    # remove weird escape characters
+    return xml_data.get("@entryName").replace("\\", replacement)
+
+
+def parse_pngs(xml_data):
+    text = xml_data.get("#text", "").split(";")
+
+    for item in text:
+        if ".png" in item:
+            if "," in item:
+                front_png, back_png = item.split(",")
+                return front_png, back_png
+            else:
+                return item, None
+    return None, None
 
-        self.front_png = None
-        self.front_png_url = None
-        self.back_png = None
-        self.back_png_url = None
 
-        self.parse_unit_xml()
-        
-        if bson_data is None:
-            # bson contained in a Unit's parent Faction
-            faction = None
-            if type(self.parent.parent.parent) is Faction:
-                # Unit has ONE command layer
-                faction = self.parent.parent.parent
-            elif type(self.parent.parent.parent) is Nation:
-                # Unit has TWO command layers
-                faction = self.parent.parent.parent.parent
-            elif type(self.parent.parent.parent) is Command:
-                # Unit has THREE command layers
-                faction = self.parent.parent.parent.parent.parent
-            else:
-                # Unit has more than two command layers
-                raise NotImplementedError("ERROR: Unit's parent Faction not in expected hierarchical location [{0}]".format(self.name))
-            
-            self.set_image_urls(faction._bson_data)
+class UnitRecord(NamedTuple):
+    # a unit, card or marker once parsing is done, the raw XML is not kept
+    name: str
+    front_png: str
+    front_png_url: str
+    back_png: str
+    back_png_url: str
+
+    def children(self):
+        return []
+
+
+def parse_unit(xml_data, cloud_index):
+    front_png, back_png = parse_pngs(xml_data)
+    return UnitRecord(parse_entry_name(xml_data), front_png, cloud_index.lookup(front_png),
+                      back_png, cloud_index.lookup(back_png))
+
+
+def parse_card(xml_data, cloud_index, back_png):
+    # as of RS89 v1.2, card data is like unit data, but the back comes from the deck
+    front_png, _ = parse_pngs(xml_data)
+    return UnitRecord(parse_entry_name(xml_data), front_png, cloud_index.lookup(front_png),
+                      back_png, cloud_index.lookup(back_png))
+
+
+def parse_marker(xml_data, cloud_index):
+    # as of RS89 v1.2 markers are like units, single sided ones show their front twice
+    unit = parse_unit(xml_data, cloud_index)
+    if unit.back_png is None:
+        unit = unit._replace(back_png=unit.front_png, back_png_url=unit.front_png_url)
+    return unit
 
-        else:
-            self.set_image_urls(bson_data)
-
-    def parse_unit_xml(self):
-        # remove weird escape characters
-        self.name = self.xml_data.get("@entryName").replace("\\", " ")
-        self._parse_unit_data()
-
-    def _parse_unit_data(self):
-        text = self.xml_data.get("#text", "").split(";")
-
-        for item in text:
-            if ".png" in item:
-                if "," in item:
-                    self.front_png, self.back_png = item.split(",")
-                    break
-                else:
-                    self.front_png = item
-                    self.back_png = None
-                    break
-
-    def set_image_urls(self, bson_data):
-        for _, file_details in bson_data.items():
-            if file_details["Name"] == self.front_png:
-                self.front_png_url = file_details["URL"]
-            if file_details["Name"] == self.back_png:
-                self.back_png_url = file_details["URL"]
-
-            if (self.front_png_url != None):
-                if (self.back_png != None):
-                    if (self.back_png_url != None):
-                        
-                        return  # both urls are set
-                else:
-                    return      # tile has no back image
-                
 
 class Command:
-    def __init__(self, parent, xml_data):
-        self.parent = parent
-        self.xml_data = xml_data
+    __slots__ = ("name", "subordinate_commands", "units", "fingerprint")
+    child_keys = ("VASSAL.build.widget.ListWidget", "VASSAL.build.widget.TabWidget", "VASSAL.build.widget.PieceSlot")
+
+    def __init__(self, xml_data, cloud_index):
         self.subordinate_commands = []
         self.units = []
-        self.parse_command_xml()
-
-    def parse_command_xml(self):
-        # remove weird escape characters
-        self.name = self.xml_data.get("@entryName", "").replace("\\", "")
-        
-        # handle case where there is another command layer:
-        subordinate_commands_raw = self.xml_data.get("VASSAL.build.widget.ListWidget", [])
-        subordinate_commands_raw += self.xml_data.get("VASSAL.build.widget.TabWidget", [])
-        
-        if type(subordinate_commands_raw) is list:
-            for subordinate_command_raw in subordinate_commands_raw:
-                self.subordinate_commands.append(Command(self, subordinate_command_raw))
-        elif type(subordinate_commands_raw) is dict:
-            self.subordinate_commands.append(Command(self, subordinate_commands_raw))
-        else:
-            print("ERROR:  bruh")
+        self.parse_command_xml(xml_data, cloud_index)
+
+    def children(self):
+        return self.subordinate_commands + self.units
+
+    def parse_command_xml(self, xml_data, cloud_index):
+        self.name = parse_entry_name(xml_data, "") if "@entryName" in xml_data else ""
+        parts = []
+
+        # handle case where there are more command layers, to any depth:
+        subordinate_commands_raw = as_list(xml_data.get("VASSAL.build.widget.ListWidget")) +\
+            as_list(xml_data.get("VASSAL.build.widget.TabWidget"))
+        for subordinate_command_raw in subordinate_commands_raw:
+            subordinate_command = Command(subordinate_command_raw, cloud_index)
+            self.subordinate_commands.append(subordinate_command)
+            parts.append(subordinate_command.fingerprint)
         
-        units_raw = self.xml_data.get("VASSAL.build.widget.PieceSlot", [])
-        if type(units_raw) is list:
-            for unit_raw in units_raw:
-                self.units.append(Unit(self, unit_raw))
-        elif type(units_raw) is dict:
-            self.units.append(Unit(self, units_raw))
-        else:
-            print("ERROR:  Command with no units??  {0}".format(self.name))
+        for unit_raw in as_list(xml_data.get("VASSAL.build.widget.PieceSlot")):
+            unit = parse_unit(unit_raw, cloud_index)
+            self.units.append(unit)
+            parts.append(record_part(unit_raw, unit))
+
+        self.fingerprint = fingerprint_node(xml_data, Command.child_keys, parts)
 
 
 class Nation:
-    def __init__(self, parent, xml_data):
-        self.xml_data = xml_data
-        self.parent = parent
+    __slots__ = ("name", "commands", "fingerprint")
+    child_keys = ("VASSAL.build.widget.ListWidget", "VASSAL.build.widget.TabWidget")
+
+    def __init__(self, xml_data, cloud_index):
         self.commands = []
-        self.parse_nation_xml()
+        self.parse_nation_xml(xml_data, cloud_index)
+
+    def children(self):
+        return self.commands
 
-    def parse_nation_xml(self):
-        # remove weird escape characters
-        self.name = self.xml_data.get("@entryName").replace("\\", " ")
+    def parse_nation_xml(self, xml_data, cloud_index):
+        self.name = parse_entry_name(xml_data)
 
-        commands_raw = self.xml_data.get("VASSAL.build.widget.ListWidget", [])
+        commands_raw = xml_data.get("VASSAL.build.widget.ListWidget", [])
         if type(commands_raw) is list:
             for command_raw in commands_raw:
-                self.commands.append(Command(self, command_raw))
+                self.commands.append(Command(command_raw, cloud_index))
         elif type(commands_raw) is dict:
-            self.commands.append(Command(self, commands_raw))
+            self.commands.append(Command(commands_raw, cloud_index))
         else:
             print("WARN:  Nation with no commands (list widget)??  {0}".format(self.name))
 
-        commands_raw_tabwidget = self.xml_data.get("VASSAL.build.widget.TabWidget", [])
+        commands_raw_tabwidget = xml_data.get("VASSAL.build.widget.TabWidget", [])
         if type(commands_raw_tabwidget) is list:
             for command_raw in commands_raw_tabwidget:
-                self.commands.append(Command(self, command_raw))
+                self.commands.append(Command(command_raw, cloud_index))
         elif type(commands_raw_tabwidget) is dict:
-            self.commands.append(Command(self, commands_raw_tabwidget))
+            self.commands.append(Command(commands_raw_tabwidget, cloud_index))
         else:
             print("WARN:  Nation with no commands (tab widget)??  {0}".format(self.name))
 
+        self.fingerprint = fingerprint_node(xml_data, Nation.child_keys, [command.fingerprint for command in self.commands])
+
 
 class Faction:
-    def __init__(self, xml_data, bson_data):
-        self._xml_data = xml_data
-        self._bson_data = bson_data
+    __slots__ = ("name", "nations", "fingerprint")
+    child_keys = ("VASSAL.build.widget.TabWidget", "VASSAL.build.widget.PanelWidget")
+
+    def __init__(self, xml_data, cloud_index):
         self.nations = []
-        self.parse_faction_xml()
+        self.parse_faction_xml(xml_data, cloud_index)
+
+    def children(self):
+        return self.nations
 
-    def parse_faction_xml(self):
-        # remove weird escape characters
-        self.name = self._xml_data.get("@entryName").replace("\\", " ")
+    def parse_faction_xml(self, xml_data, cloud_index):
+        self.name = parse_entry_name(xml_data)
 
         # A VASSAL.build.module.TabWidget or VASSAL.build.module.PanelWidget may represent a Nation
-        tab_nations = self._xml_data.get("VASSAL.build.widget.TabWidget", [])
-        panel_nations = self._xml_data.get("VASSAL.build.widget.PanelWidget", [])
+        tab_nations = xml_data.get("VASSAL.build.widget.TabWidget", [])
+        panel_nations = xml_data.get("VASSAL.build.widget.PanelWidget", [])
 
         if type(tab_nations) is list:
             for tab_nation in tab_nations:
-                self.nations.append(Nation(self, tab_nation))
+                self.nations.append(Nation(tab_nation, cloud_index))
         elif type(tab_nations) is dict:
-            self.nations.append(Nation(self, tab_nations))
+            self.nations.append(Nation(tab_nations, cloud_index))
         else:
             print("WARN:  Faction with no tab nations?? {0}".format(self.name))
 
         if type(panel_nations) is list:
             for panel_nation in panel_nations:
-                self.nations.append(Nation(self, panel_nation))
+                self.nations.append(Nation(panel_nation, cloud_index))
         elif type(panel_nations) is dict:
-            self.nations.append(Nation(self, panel_nations))
+            self.nations.append(Nation(panel_nations, cloud_index))
         else:
             print("WARN:  Faction with no panel nations?? {0}".format(self.name))
 
-
-class Card:
-    def __init__(self, parent, xml_data, bson_data, back_png):
-        self.parent = parent
-        self._xml_data = xml_data
-        
-        self.front_png = None
-        self.front_png_url = None
-
-        self.back_png = back_png
-        self.back_png_url = None
-        self.parse_card_xml(bson_data)
-
-    def parse_card_xml(self, bson_data):
-        # as of RS89 v1.2, card data is like unit data
-        _unit = Unit(None, self._xml_data, bson_data)
-
-        # hack:  set back png then set image urls again
-        _unit.back_png = self.back_png
-        _unit.back_png_url = None
-        _unit.set_image_urls(bson_data)
-
-        self.name = _unit.name
-        self.front_png = _unit.front_png
-        self.front_png_url = _unit.front_png_url
-        self.back_png_url = _unit.back_png_url
+        self.fingerprint = fingerprint_node(xml_data, Faction.child_keys, [nation.fingerprint for nation in self.nations])
 
 
 class Deck:
+    __slots__ = ("name", "cards", "fingerprint")
     nato_back_png = "NATO_Card_Back.png"
     wp_back_png = "WP_Card_Back.png"
 
-    def __init__(self, xml_data, bson_data):
-        self._xml_data = xml_data
+    def __init__(self, xml_data, cloud_index):
         self.cards = []
-        self.parse_deck_xml(bson_data)
+        self.parse_deck_xml(xml_data, cloud_index)
 
-    def parse_deck_xml(self, bson_data):
-        # remove weird escape characters
-        self.name = self._xml_data.get("@entryName").replace("\\", " ")
-        cards_raw = self._xml_data["VASSAL.build.widget.ListWidget"]["VASSAL.build.widget.PieceSlot"]
+    def parse_deck_xml(self, xml_data, cloud_index):
+        self.name = parse_entry_name(xml_data)
+        cards_raw = xml_data["VASSAL.build.widget.ListWidget"]["VASSAL.build.widget.PieceSlot"]
+        parts = []
 
         for card_raw in cards_raw:
             if "NATO" in self.name:
-                self.cards.append(Card(self, card_raw, bson_data, Deck.nato_back_png))
+                card = parse_card(card_raw, cloud_index, Deck.nato_back_png)
             elif "WP" in self.name:
-                self.cards.append(Card(self, card_raw, bson_data, Deck.wp_back_png))
+                card = parse_card(card_raw, cloud_index, Deck.wp_back_png)
             else:
                 print("[WARN] bad deck??")
+                continue
+            self.cards.append(card)
+            parts.append(record_part(card_raw, card))
+
+        self.fingerprint = fingerprint_node(xml_data, ("VASSAL.build.widget.ListWidget",), parts)
 
 
 class MarkerCategory:
-    def __init__(self, xml_data, bson_data):
-        self._xml_data = xml_data
+    __slots__ = ("name", "markers", "fingerprint")
+
+    def __init__(self, xml_data, cloud_index):
         self.markers = []
-        self.parse_category_xml(bson_data)
+        self.parse_category_xml(xml_data, cloud_index)
 
-    def parse_category_xml(self, bson_data):
-        # as of RS89 v1.2 markers are like units
-        self.name = self._xml_data.get("@entryName").replace("\\", " ")
-        markers_raw = self._xml_data["VASSAL.build.widget.PieceSlot"]
+    def parse_category_xml(self, xml_data, cloud_index):
+        self.name = parse_entry_name(xml_data)
+        markers_raw = xml_data["VASSAL.build.widget.PieceSlot"]
+        parts = []
 
         for marker_raw in markers_raw:
             try:
-                _unit = Unit(self, marker_raw, bson_data)
-                if _unit.back_png is None:
-                    _unit.back_png = _unit.front_png
-                    _unit.back_png_url = _unit.front_png_url
-
-                self.markers.append(_unit)
+                marker = parse_marker(marker_raw, cloud_index)
+                self.markers.append(marker)
+                parts.append(record_part(marker_raw, marker))
             except ValueError as e:
                 print("Weird Marker:  {0}".format(marker_raw.get("@entryName")))
 
+        self.fingerprint = fingerprint_node(xml_data, ("VASSAL.build.widget.PieceSlot",), parts)
+
 
 def extract_vassal_file(vmod_path, vmod_temp):
     # create temp directory
@@ -249,10 +375,10 @@ def extract_vassal_file(vmod_path, vmod_temp):
         vmod_zip.extractall(vmod_temp)
 
 
-def parse_redstrike_hierarchy(buildfile_path, bson_data):
+def parse_redstrike_hierarchy(buildfile_path, cloud_index, workers=1):
     # actual processing
     data_raw = None
-    with open(buildfile_path, 'r') as f:
+    with open(buildfile_path, 'r') as f, span("xmltodict.parse"):
         data_raw = xmltodict.parse(f.read())
 
     # A VASSAL.build.module.PieceWindow (there are more than one) contains a set of
@@ -264,81 +390,245 @@ def parse_redstrike_hierarchy(buildfile_path, bson_data):
     decks = []
     markers = []
 
-    for entry_raw in entries_raw:
-        entryName = entry_raw.get("@entryName")
+    if workers == 1:
+        for entry_raw in entries_raw:
+            parse_redstrike_entry(entry_raw, cloud_index, factions, decks, markers)
+    else:
+        with entry_pool(cloud_index, workers) as executor:
+            merge_entry_results(executor.map(_parse_entry_worker, entries_raw), cloud_index, factions, decks, markers)
+
+    return factions, decks, markers
+
+
+def parse_redstrike_entry(entry_raw, cloud_index, factions, decks, markers):
+    entryName = entry_raw.get("@entryName")
+
+    if not ((entryName == "Markers") or (entryName == "Cards")):
+        factions.append(Faction(entry_raw, cloud_index))
+    
+    if (entryName == "Cards"):
+        decks_raw = entry_raw["VASSAL.build.widget.TabWidget"]
+        for deck_raw in decks_raw:
+            decks.append(Deck(deck_raw, cloud_index))
+
+    if (entryName == "Markers"):
+        # All markers are in separated into categories by a ListWidget
+        marker_categories_raw = entry_raw["VASSAL.build.widget.ListWidget"]
+        for category_raw in marker_categories_raw:
+            markers.append(MarkerCategory(category_raw, cloud_index))
+
+
+# per worker process, filled once by _init_entry_worker
+_worker_cloud_index = None
+
+
+def _init_entry_worker(urls):
+    global _worker_cloud_index
+    _worker_cloud_index = CloudIndex.from_urls(urls)
+
+
+def _parse_entry_worker(entry_raw):
+    # one top level TabWidget entry, the lookups it made travel back for the parent's report
+    factions = []
+    decks = []
+    markers = []
+    _worker_cloud_index.requested = set()
+    _worker_cloud_index.missing = set()
+    parse_redstrike_entry(entry_raw, _worker_cloud_index, factions, decks, markers)
+    return factions, decks, markers, _worker_cloud_index.requested, _worker_cloud_index.missing
 
-        if not ((entryName == "Markers") or (entryName == "Cards")):
-            factions.append(Faction(entry_raw, bson_data))
-        
-        if (entryName == "Cards"):
-            decks_raw = entry_raw["VASSAL.build.widget.TabWidget"]
-            for deck_raw in decks_raw:
-                decks.append(Deck(deck_raw, bson_data))
 
-        if (entryName == "Markers"):
-            # All markers are in separated into categories by a ListWidget
-            marker_categories_raw = entry_raw["VASSAL.build.widget.ListWidget"]
-            for category_raw in marker_categories_raw:
-                markers.append(MarkerCategory(category_raw, bson_data))
+def entry_pool(cloud_index, workers=None):
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_entry_worker, initargs=(cloud_index.resolved_urls(),))
+
+
+def merge_entry_results(results, cloud_index, factions, decks, markers):
+    # in entry order, so the output matches the serial path
+    for entry_factions, entry_decks, entry_markers, requested, missing in results:
+        factions += entry_factions
+        decks += entry_decks
+        markers += entry_markers
+        cloud_index.requested |= requested
+        cloud_index.missing |= missing
+
+
+def parse_redstrike_vmod(vmod_path, cloud_index, buildfile_name="buildFile.xml", workers=1):
+    # streaming alternative to extract_vassal_file + parse_redstrike_hierarchy:
+    ## buildFile.xml is read straight out of the vmod and each entry of the 0th PieceWindow
+    ## is turned into objects as soon as its subtree closes, images are never touched
+    ## workers > 1: entries go to worker processes while the rest of the xml is still being read
+    factions = []
+    decks = []
+    markers = []
+    piece_window = None
+    executor = entry_pool(cloud_index, workers) if workers != 1 else None
+    pending = []
+
+    def handle_entry(path, entry_raw):
+        nonlocal piece_window
+        # GameModule -> PieceWindow -> TabWidget -> TabWidget
+        if path[1][0] != "VASSAL.build.module.PieceWindow":
+            return True
+        if piece_window is None:
+            piece_window = path[1]
+        elif path[1] is not piece_window:
+            # past the 0th PieceWindow, nothing left to parse
+            return False
+
+        if path[2][0] == "VASSAL.build.widget.TabWidget" and path[3][0] == "VASSAL.build.widget.TabWidget":
+            if executor is None:
+                parse_redstrike_entry(entry_raw, cloud_index, factions, decks, markers)
+            else:
+                pending.append(executor.submit(_parse_entry_worker, entry_raw))
+        return True
+
+    try:
+        with ZipFile(vmod_path, 'r') as vmod_zip:
+            with vmod_zip.open(buildfile_name, 'r') as buildfile:
+                try:
+                    xmltodict.parse(buildfile, item_depth=4, item_callback=handle_entry)
+                except xmltodict.ParsingInterrupted:
+                    pass
+        merge_entry_results((future.result() for future in pending), cloud_index, factions, decks, markers)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     return factions, decks, markers
 
 
+# BSON element type -> size of its value, for the types whose size is not stored in the value itself
+BSON_FIXED_SIZES = {
+    0x01: 8,    # double
+    0x06: 0,    # undefined
+    0x07: 12,   # ObjectId
+    0x08: 1,    # bool
+    0x09: 8,    # UTC datetime
+    0x0A: 0,    # null
+    0x10: 4,    # int32
+    0x11: 8,    # timestamp
+    0x12: 8,    # int64
+    0x13: 16,   # decimal128
+    0x7F: 0,    # max key
+    0xFF: 0,    # min key
+}
+
+
+def _bson_skip_value(data, element_type, pos):
+    if element_type in BSON_FIXED_SIZES:
+        return pos + BSON_FIXED_SIZES[element_type]
+    if element_type in (0x02, 0x0D, 0x0E):
+        # string, JavaScript code, symbol: int32 length (including the NUL), bytes
+        return pos + 4 + struct.unpack_from("<i", data, pos)[0]
+    if element_type in (0x03, 0x04, 0x0F):
+        # document, array, code with scope: int32 total size
+        return pos + struct.unpack_from("<i", data, pos)[0]
+    if element_type == 0x05:
+        # binary: int32 length, subtype byte, bytes
+        return pos + 5 + struct.unpack_from("<i", data, pos)[0]
+    if element_type == 0x0B:
+        # regex: two cstrings
+        return data.find(b"\x00", data.find(b"\x00", pos) + 1) + 1
+    if element_type == 0x0C:
+        # DBPointer: string, ObjectId
+        return pos + 4 + struct.unpack_from("<i", data, pos)[0] + 12
+    raise ValueError("unknown BSON element type 0x{0:02x} at offset {1}".format(element_type, pos))
+
+
+def _bson_elements(data, start):
+    # (type, raw key bytes, value offset) for each element of the document at start
+    end = start + struct.unpack_from("<i", data, start)[0] - 1
+    pos = start + 4
+    while pos < end:
+        element_type = data[pos]
+        key_end = data.find(b"\x00", pos + 1)
+        value_pos = key_end + 1
+        yield element_type, data[pos + 1:key_end], value_pos
+        pos = _bson_skip_value(data, element_type, value_pos)
+
+
+def _bson_string(data, pos):
+    length = struct.unpack_from("<i", data, pos)[0]
+    return data[pos + 4:pos + 4 + length - 1].decode("utf-8")
+
+
 def parse_bson(bson_path):
+    # CloudInfo.bson is one document of documents, only their Name and URL strings are decoded,
+    ## every other field is stepped over using the BSON element framing of the memory-mapped file
     data = {}
     with open(bson_path, 'rb') as bson_file:
-        data = bson.loads(bson_file.read())
+        with mmap.mmap(bson_file.fileno(), 0, access=mmap.ACCESS_READ) as bson_map:
+            for element_type, key, value_pos in _bson_elements(bson_map, 0):
+                if element_type != 0x03:
+                    continue
+
+                file_details = {}
+                for field_type, field, field_pos in _bson_elements(bson_map, value_pos):
+                    if field_type == 0x02 and (field == b"Name" or field == b"URL"):
+                        file_details[field.decode()] = _bson_string(bson_map, field_pos)
+
+                if "Name" in file_details:
+                    file_details.setdefault("URL", None)
+                    data[key.decode("utf-8")] = file_details
     return data
             
 
-def publish_faction_json(factions, json_path):
-    # build dictionary representation
+def walk_hierarchy(node, path=()):
+    # (path, node) for everything below a Faction/Nation/Command, depth first, any depth
+    for child in node.children():
+        child_path = path + (child.name,)
+        yield child_path, child
+        yield from walk_hierarchy(child, child_path)
+
+
+def unit_dict(unit):
+    return {
+        "front_png":        unit.front_png,
+        "front_png_url":    unit.front_png_url,
+        "back_png":         unit.back_png,
+        "back_png_url":     unit.back_png_url
+    }
+
+
+def iter_hierarchy_json(nodes, indent=4, level=0):
+    # json.dump(..., indent=4) layout of {name: subtree or unit_dict}, generated one node at a time
+    named = {}
+    for node in nodes:
+        named[node.name] = node     # same name twice: first position, last value, like a dict
+
+    if not named:
+        yield "{}"
+        return
+
+    child_indent = "\n" + " " * (indent * (level + 1))
+    yield "{"
+    for i, (name, node) in enumerate(named.items()):
+        yield ("," if i else "") + child_indent + json.dumps(name) + ": "
+        if type(node) is UnitRecord:
+            yield json.dumps(unit_dict(node), indent=indent).replace("\n", child_indent)
+        else:
+            yield from iter_hierarchy_json(node.children(), indent, level + 1)
+    yield "\n" + " " * (indent * level) + "}"
+
+
+def hierarchy_data(nodes):
+    # the same {name: subtree or unit_dict} that iter_hierarchy_json writes, as python objects
     data = {}
-    for faction in factions:
-        faction_dict = {}
-        for nation in faction.nations:
-            nation_dict = {}
-            for command in nation.commands:
-                command_dict = {}
-                for subordinate_command in command.subordinate_commands:
-                    subordinate_command_dict = {}
-                    for subordinate_command2 in subordinate_command.subordinate_commands:
-                        subordinate_command2_dict = {}  # :/ this is getting ugly
-                        for unit in subordinate_command2.units:
-                            unit_dict = {
-                                "front_png":        unit.front_png,
-                                "front_png_url":    unit.front_png_url,
-                                "back_png":         unit.back_png,
-                                "back_png_url":     unit.back_png_url
-                            }
-                            subordinate_command2_dict[unit.name] = unit_dict
-                        subordinate_command_dict[subordinate_command2.name] = subordinate_command2_dict
-                    for unit in subordinate_command.units:
-                        unit_dict = {
-                            "front_png":        unit.front_png,
-                            "front_png_url":    unit.front_png_url,
-                            "back_png":         unit.back_png,
-                            "back_png_url":     unit.back_png_url
-                        }
-                        subordinate_command_dict[unit.name] = unit_dict
-                    command_dict[subordinate_command.name] = subordinate_command_dict
-                for unit in command.units:
-                    unit_dict = {
-                        "front_png":        unit.front_png,
-                        "front_png_url":    unit.front_png_url,
-                        "back_png":         unit.back_png,
-                        "back_png_url":     unit.back_png_url
-                    }
-                    command_dict[unit.name] = unit_dict
-                nation_dict[command.name] = command_dict
-            faction_dict[nation.name] = nation_dict
-        data[faction.name] = faction_dict
-    
+    for node in nodes:
+        if type(node) is UnitRecord:
+            data[node.name] = unit_dict(node)
+        else:
+            data[node.name] = hierarchy_data(node.children())
+    return data
+
+
+def publish_faction_json(factions, json_path):
     with open(json_path, 'w') as json_file:
-        json.dump(data, json_file, indent=4)
+        for chunk in iter_hierarchy_json(factions):
+            json_file.write(chunk)
 
 
-def publish_decks_json(decks, json_path):
+def decks_data(decks):
     data = {}
 
     for deck in decks:
@@ -352,12 +642,50 @@ def publish_decks_json(decks, json_path):
             }
             deck_dict[card.name] = card_dict
         data[deck.name] = deck_dict
+    return data
+
 
+def publish_decks_json(decks, json_path):
     with open(json_path, 'w') as json_file:
-        json.dump(data, json_file, indent=4)
+        json.dump(decks_data(decks), json_file, indent=4)
 
 
-def publish_markers_json(markers, json_path):
+def card_atlases_data(decks, layout_path, cloud_index):
+    # sheets built by card_atlas.py, with their Steam Cloud URLs, for import_tts.createDeck
+    ## a sheet is left out when it was not uploaded yet or its cards no longer match the deck
+    with open(layout_path, 'r') as layout_file:
+        layout = json.load(layout_file)
+
+    data = {}
+    for deck in decks:
+        cards = {card.name: card for card in deck.cards}
+        sheets = []
+        for sheet in layout.get(deck.name, []):
+            face_url = cloud_index.lookup(sheet["sheet"])
+            current_pngs = [cards[name].front_png if name in cards else None for name in sheet["cards"]]
+            if face_url is None or current_pngs != sheet["front_pngs"]:
+                print("WARN:  card sheet {0} is missing or out of date, rerun card_atlas.py".format(sheet["sheet"]))
+                continue
+            sheets.append({
+                "face_url":     face_url,
+                "num_width":    sheet["num_width"],
+                "num_height":   sheet["num_height"],
+                "cards":        sheet["cards"]
+            })
+        if sheets:
+            data[deck.name] = {
+                "back_url":     deck.cards[0].back_png_url,
+                "sheets":       sheets
+            }
+    return data
+
+
+def publish_card_atlases_json(decks, layout_path, cloud_index, json_path):
+    with open(json_path, 'w') as json_file:
+        json.dump(card_atlases_data(decks, layout_path, cloud_index), json_file, indent=4)
+
+
+def markers_data(markers):
     data = {}
 
     for category in markers:
@@ -371,31 +699,106 @@ def publish_markers_json(markers, json_path):
             }
             category_dict[marker.name] = marker_dict
         data[category.name] = category_dict
+    return data
+
 
+def publish_markers_json(markers, json_path):
     with open(json_path, 'w') as json_file:
-        json.dump(data, json_file, indent=4)
+        json.dump(markers_data(markers), json_file, indent=4)
+
+
+def fingerprints_data(factions, decks, markers):
+    # consumed by import_tts.py's incremental mode
+    data = {"factions": {}, "decks": {}, "markers": {}}
+
+    for faction in factions:
+        data["factions"][faction.name] = {
+            "fingerprint":  faction.fingerprint,
+            "nations":      {nation.name: {
+                "fingerprint":  nation.fingerprint,
+                "commands":     {command.name: command.fingerprint for command in nation.commands}
+            } for nation in faction.nations}
+        }
+
+    for deck in decks:
+        data["decks"][deck.name] = deck.fingerprint
+
+    for category in markers:
+        data["markers"][category.name] = category.fingerprint
+    return data
+
+
+def publish_fingerprints_json(factions, decks, markers, json_path):
+    with open(json_path, 'w') as json_file:
+        json.dump(fingerprints_data(factions, decks, markers), json_file, indent=4)
 
 
 def cleanup(vmod_temp):
     shutil.rmtree(vmod_temp)
 
 
+def parse_vmod_data(vmod_path, bson_path, dedupe_images=True, workers=1, vmod_temp=None, image_hash_cache_path=None):
+    # CloudInfo.bson -> URL index -> image dedup -> buildFile.xml, one span per step
+    ## vmod_temp: extract the whole vmod there and parse from disk instead of streaming buildFile.xml
+    ## image_hash_cache_path: an ImageHashCache json, only pngs that changed since the last run get decoded
+    ## returns factions, decks, markers and the cloud index, whose report() is left to the caller
+    with span("bson load") as stage:
+        bson_data = parse_bson(bson_path)
+        stage.items = len(bson_data)
+    with span("url index") as stage:
+        cloud_index = CloudIndex(bson_data)
+        stage.items = len(cloud_index.urls)
+    if dedupe_images:
+        with span("image dedup") as stage:
+            image_hash_cache = ImageHashCache(image_hash_cache_path)
+            content_hashes = image_content_hashes(vmod_path, cloud_index.urls, cache=image_hash_cache)
+            image_hash_cache.save()
+            cloud_index.dedupe(content_hashes)
+            stage.items = len(content_hashes)
+    if vmod_temp is None:
+        with span("parse buildFile.xml") as stage:
+            factions, decks, markers = parse_redstrike_vmod(vmod_path, cloud_index, workers=workers)
+            stage.items = len(cloud_index.requested)
+    else:
+        with span("vmod extraction"):
+            extract_vassal_file(vmod_path, vmod_temp)
+        with span("parse buildFile.xml") as stage:
+            factions, decks, markers = parse_redstrike_hierarchy(os.path.join(vmod_temp, "buildFile.xml"), cloud_index, workers)
+            stage.items = len(cloud_index.requested)
+        cleanup(vmod_temp)
+    return factions, decks, markers, cloud_index
+
+
 if __name__ == "__main__":
     vmod_temp = "./temp"
     vmod_path = "./Red_Strike_V1_2.vmod"
     bson_path = "./CloudInfo.bson"
-    buildfile_path = os.path.abspath("{0}//{1}".format(vmod_temp, "buildFile.xml"))
     factions_json_path = "{0}_factions.json".format(vmod_path)
     cards_json_path = "{0}_cards.json".format(vmod_path)
     markers_json_path = "{0}_markers.json".format(vmod_path)
-
-    extract_vassal_file(vmod_path, vmod_temp)
-    bson_data = parse_bson(bson_path)
-    factions, decks, markers = parse_redstrike_hierarchy(buildfile_path, bson_data)
-    cleanup(vmod_temp)
+    fingerprints_json_path = "{0}_fingerprints.json".format(vmod_path)
+    card_atlases_layout_path = "./card_atlases.json"
+    card_atlases_json_path = "{0}_card_atlases.json".format(vmod_path)
+    image_hash_cache_path = "{0}_image_hashes.json".format(vmod_path)
+    streaming = True    # False extracts the whole vmod to vmod_temp first
+    parse_workers = os.cpu_count()  # 1 parses every entry in this process, for debugging
+    dedupe_images = True    # point pixel-identical pngs at one URL, pngs are only decoded again when they change (image_hash_cache_path)
+    instrument = False  # stage timings to {vmod}_parse_report.json
+    profile_dir = None  # e.g. "./profiles", one cProfile dump per stage
+
+    recorder.configure(instrument, profile_dir=profile_dir)
+    factions, decks, markers, cloud_index = parse_vmod_data(vmod_path, bson_path, dedupe_images, parse_workers,
+                                                            None if streaming else vmod_temp, image_hash_cache_path)
+    cloud_index.report()
 
     # jsons for debugging
-    publish_faction_json(factions, factions_json_path)
-    publish_decks_json(decks, cards_json_path)
-    publish_markers_json(markers, markers_json_path)
+    with span("json dump"):
+        publish_faction_json(factions, factions_json_path)
+        publish_decks_json(decks, cards_json_path)
+        publish_markers_json(markers, markers_json_path)
+        publish_fingerprints_json(factions, decks, markers, fingerprints_json_path)
+        if os.path.exists(card_atlases_layout_path):
+            publish_card_atlases_json(decks, card_atlases_layout_path, cloud_index, card_atlases_json_path)
+    if instrument:
+        recorder.report("{0}_parse_report.json".format(vmod_path))
     print("DONE!")
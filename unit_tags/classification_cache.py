@@ -0,0 +1,65 @@
+"""On-disk cache of template matching results, keyed by ROI pixels and the template set that scored them."""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def roi_key(roi):
+    roi = np.ascontiguousarray(roi)
+    digest = hashlib.blake2b(str(roi.shape).encode(), digest_size=16)
+    digest.update(roi.data)
+    return digest.hexdigest()
+
+
+class ClassificationCache:
+    # fingerprint of a template set -> {roi_key: [entry value or None, score]}
+    ## fingerprints that are not asked for during a run are dropped on save, so editing the
+    ## templates of one enum only invalidates the results of that enum
+
+    def __init__(self, path=None, tables=None):
+        self.path = path
+        self.tables = tables if tables is not None else {}
+        self.used = set()
+        self.added = {}
+        self.hits = 0
+        self.misses = 0
+        if tables is None and path is not None and os.path.exists(path):
+            with open(path, "r") as f:
+                self.tables = json.load(f)
+
+    def lookup(self, fingerprint, key):
+        self.used.add(fingerprint)
+        value = self.tables.get(fingerprint, {}).get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def store(self, fingerprint, key, entry, score):
+        value = [None if entry is None else str(entry), score]
+        self.tables.setdefault(fingerprint, {})[key] = value
+        self.added.setdefault(fingerprint, {})[key] = value
+
+    def take_changes(self):
+        # everything a worker process' copy learned since the last call, see merge
+        changes = (self.added, set(self.used), self.hits, self.misses)
+        self.added = {}
+        self.hits = 0
+        self.misses = 0
+        return changes
+
+    def merge(self, changes):
+        added, used, hits, misses = changes
+        self.used.update(used)
+        self.hits += hits
+        self.misses += misses
+        for fingerprint, table in added.items():
+            self.tables.setdefault(fingerprint, {}).update(table)
+
+    def save(self):
+        tables = {fingerprint: self.tables[fingerprint] for fingerprint in self.used if fingerprint in self.tables}
+        with open(self.path, "w") as f:
+            json.dump(tables, f)
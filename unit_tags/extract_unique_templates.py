@@ -1,85 +1,173 @@
 """This script extracts NATO symbology templates from the Red_Strike_V1_2.vmod archive and packages them for future manual processing"""
 import os
 import hashlib
-import shutil
+import json
 import zipfile
 import unit_data_entry
 
-from PIL import Image
 import numpy as np
+from image_source import ZipImageSource, crop_box, encode_image
 
-def extract_roi(src_dir, dst_dir, x1, y1, x2, y2):
-    if not os.path.exists(dst_dir):
-        os.makedirs(dst_dir)
-    for filename in os.listdir(src_dir):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            src_path = os.path.join(src_dir, filename)
-            dst_path = os.path.join(dst_dir, filename)
+# name -> (x1, y1, x2, y2) in counter image coordinates, also the output folder below unsorted_templates
+ROIS = {
+    "unit_formation_templates": (90, 39, 131, 51),
+    "unit_type_templates": (90, 51, 131, 72),
+}
+
+def extract_roi(image_source, x1, y1, x2, y2):
+    for filename, img in image_source:
+        yield filename, crop_box(img, x1, y1, x2, y2)
+
+def area_weights(src_size, dst_size):
+    # dst_size x src_size matrix that averages the source pixels covered by each destination pixel
+    weights = np.zeros((dst_size, src_size))
+    scale = src_size / dst_size
+    for i in range(dst_size):
+        start, end = i * scale, (i + 1) * scale
+        for j in range(int(start), min(int(np.ceil(end)), src_size)):
+            weights[i, j] = min(end, j + 1) - max(start, j)
+    return weights / scale
+
+def perceptual_hashes(images, hash_shape=None):
+    # average-style hashes of equally sized BGR images as ints, all at once: grayscale, area resize to hash_shape,
+    ## one bit per pixel darker than the middle of that image's gray range
+    ## hash_shape None hashes at native size, the ROI strips are too narrow for the usual 8x8
+    ## (at 8x8 one formation dot or bar is 0-2 bits, at native size the closest distinct symbols are 8 bits apart)
+    stack = np.stack(images).astype(np.float64)
+    gray = stack @ np.array([0.114, 0.587, 0.299])
+    rows, cols = hash_shape if hash_shape is not None else gray.shape[1:3]
+    small = np.einsum("ry,nyx,cx->nrc", area_weights(gray.shape[1], rows), gray, area_weights(gray.shape[2], cols))
+    middle = (small.min(axis=(1, 2), keepdims=True) + small.max(axis=(1, 2), keepdims=True)) / 2
+    bits = np.packbits((small < middle).reshape(len(images), -1), axis=1)
+    return [int.from_bytes(row.tobytes(), "big") for row in bits]
+
+class BKTree:
+    # metric tree over hamming distance, finds every stored hash within a radius without comparing against all of them
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = (value, item, {})
+            return
+        node = self.root
+        while True:
+            distance = bin(value ^ node[0]).count("1")
+            if distance not in node[2]:
+                node[2][distance] = (value, item, {})
+                return
+            node = node[2][distance]
+
+    def search(self, value, radius):
+        # (distance, item) pairs within radius
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = bin(value ^ node[0]).count("1")
+            if distance <= radius:
+                found.append((distance, node[1]))
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return found
+
+def cluster_images(images, max_distance):
+    # leader clustering in input order: an image joins the closest earlier exemplar within max_distance
+    ## bits of perceptual hash, or becomes an exemplar itself; returns {exemplar index: [member indices]}
+    hashes = [None] * len(images)
+    by_shape = {}
+    for i, (_, img) in enumerate(images):
+        by_shape.setdefault(img.shape, []).append(i)
+    for indices in by_shape.values():
+        for i, h in zip(indices, perceptual_hashes([images[i][1] for i in indices])):
+            hashes[i] = (images[i][1].shape, h)
+
+    trees = {}
+    clusters = {}
+    for i, (shape, h) in enumerate(hashes):
+        tree = trees.setdefault(shape, BKTree())
+        matches = tree.search(h, max_distance)
+        if matches:
+            clusters[min(matches)[1]].append(i)
+        else:
+            tree.add(h, i)
+            clusters[i] = [i]
+    return clusters
+
+def extract_unique_rois(image_source, rois, dst_zip, dst_subdir="unsorted", max_distance=None):
+    # single pass: every counter is decoded once, each ROI is a view into it and deduped by its own hash set
+    ## max_distance: cluster near-duplicates instead, see copy_unique_images
+    if max_distance is not None:
+        crops = {name: [] for name in rois}
+        for filename, img in image_source:
+            for name, box in rois.items():
+                crops[name].append((filename, crop_box(img, *box).copy()))
+        return {name: copy_unique_images(crops[name], dst_zip, f"{name}/{dst_subdir}", max_distance) for name in rois}
+
+    hashes = {name: set() for name in rois}
+    counts = {name: 0 for name in rois}
+    for filename, img in image_source:
+        for name, box in rois.items():
             try:
-                img = Image.open(src_path).convert('RGB')
-                cropped = img.crop((x1, y1, x2, y2))
-                cropped.save(dst_path)
+                roi = crop_box(img, *box)
+                img_hash = hashlib.blake2b(np.ascontiguousarray(roi).data, digest_size=16).digest()
+                if img_hash not in hashes[name]:
+                    hashes[name].add(img_hash)
+                    dst_zip.writestr(f"{name}/{dst_subdir}/{filename}", encode_image(filename, roi))
+                    counts[name] += 1
             except Exception as e:
-                continue
-
-def copy_unique_images(src_dir, dst_dir):
-    if not os.path.exists(dst_dir):
-        os.makedirs(dst_dir)
-    
-    hashes = set()
-    for filename in os.listdir(src_dir):
-        if filename.lower().endswith((".png", ".jpg", ".jpeg")):
-            path = os.path.join(src_dir, filename)
+                print(f"Error processing {filename}: {e}")
+    return counts
+
+def copy_unique_images(images, dst_zip, dst_dir, max_distance=None):
+    # max_distance None: exact pixel dedup; otherwise one exemplar per perceptual hash cluster,
+    ## with dst_dir/clusters.json listing the files each exemplar stands for
+    if max_distance is None:
+        hashes = set()
+        for filename, img in images:
             try:
-                img = Image.open(path).convert("RGB")
-                arr = np.array(img)
-                img_bytes = arr.tobytes()
-                img_hash = hashlib.sha256(img_bytes).hexdigest()
+                img_hash = hashlib.sha256(img.tobytes()).hexdigest()
                 if img_hash not in hashes:
                     hashes.add(img_hash)
-                    dst_path = os.path.join(dst_dir, filename)
-                    img.save(dst_path)
+                    dst_zip.writestr(f"{dst_dir}/{filename}", encode_image(filename, img))
             except Exception as e:
                 print(f"Error processing {filename}: {e}")
+        return len(hashes)
 
+    images = list(images)
+    clusters = cluster_images(images, max_distance)
+    manifest = {}
+    for exemplar, members in clusters.items():
+        filename, img = images[exemplar]
+        try:
+            dst_zip.writestr(f"{dst_dir}/{filename}", encode_image(filename, img))
+            manifest[filename] = [images[member][0] for member in members]
+        except Exception as e:
+            print(f"Error processing {filename}: {e}")
+    dst_zip.writestr(f"{dst_dir}/clusters.json", json.dumps(manifest, indent=4))
+    return len(manifest)
 
-if __name__ == "__main__":
-    zipfiles = [
-        "Red_Strike_V1_2.vmod",
-    ]
 
-    for zf in zipfiles:
-        if not os.path.exists(zf):
-            raise FileNotFoundError(f"{zf} not found in the current directory.")
-        else:
-            with zipfile.ZipFile(zf, "r") as zip_ref:
-                zip_ref.extractall(os.path.splitext(zf)[0])
+if __name__ == "__main__":
+    vmod_path = "Red_Strike_V1_2.vmod"
+    max_distance = None     # bits of perceptual hash for near-duplicates to share a template, e.g. 2 (one dot is 8), None keeps exact dedup
+    if not os.path.exists(vmod_path):
+        raise FileNotFoundError(f"{vmod_path} not found in the current directory.")
 
-    if os.path.exists("./unsorted_templates"):
-        shutil.rmtree("./unsorted_templates")
     if os.path.exists("./unsorted_templates.zip"):
         os.remove("./unsorted_templates.zip")
 
-    os.mkdir("./unsorted_templates")
-    os.mkdir("./unsorted_templates/unit_type_templates")
-    os.mkdir("./unsorted_templates/unit_type_templates/unsorted")
-    os.mkdir("./unsorted_templates/unit_formation_templates")
-    os.mkdir("./unsorted_templates/unit_formation_templates/unsorted")
-    
-    for size in unit_data_entry.UnitType:
-        os.mkdir(os.path.join("./unsorted_templates/unit_type_templates", size))
-
-    for formation in unit_data_entry.UnitFormation:
-        os.mkdir(os.path.join("./unsorted_templates/unit_formation_templates", formation)) 
-
-    extract_roi("Red_Strike_V1_2/images", "extract_formation_templates", 90, 39, 131, 51)
-    copy_unique_images("extract_formation_templates", "./unsorted_templates/unit_formation_templates/unsorted")
-    extract_roi("Red_Strike_V1_2/images", "extract_type_templates", 90, 51, 131, 72)
-    copy_unique_images("extract_type_templates", "./unsorted_templates/unit_type_templates/unsorted")
-
-    archive_path = shutil.make_archive("unsorted_templates", "zip", "unsorted_templates")
-
-    shutil.rmtree("Red_Strike_V1_2")
-    shutil.rmtree("extract_formation_templates")
-    shutil.rmtree("extract_type_templates")
-    shutil.rmtree("unsorted_templates")
+    with ZipImageSource(vmod_path, "images") as image_source,\
+        zipfile.ZipFile("unsorted_templates.zip", "w", zipfile.ZIP_DEFLATED) as dst_zip:
+        # empty folders for the manual sorting
+        dst_zip.writestr("unit_type_templates/unsorted/", "")
+        dst_zip.writestr("unit_formation_templates/unsorted/", "")
+        for size in unit_data_entry.UnitType:
+            dst_zip.writestr(f"unit_type_templates/{size}/", "")
+        for formation in unit_data_entry.UnitFormation:
+            dst_zip.writestr(f"unit_formation_templates/{formation}/", "")
+
+        counts = extract_unique_rois(image_source, ROIS, dst_zip, max_distance=max_distance)
+        for name, count in counts.items():
+            print(f"{name}: {count} unique templates")
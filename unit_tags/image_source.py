@@ -0,0 +1,97 @@
+"""Reads counter images straight out of zip archives (the vmod, input_images.zip, templates.zip) without extracting them to disk."""
+import os
+import zipfile
+
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def decode_image(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+
+def encode_image(name, img):
+    # encoded in the format the file extension asks for, like PIL's Image.save
+    ok, buffer = cv2.imencode(os.path.splitext(name)[1].lower(), img)
+    if not ok:
+        raise ValueError(f"could not encode {name}")
+    return buffer.tobytes()
+
+
+def crop_box(img, x1, y1, x2, y2):
+    # same box semantics as PIL's Image.crop, area outside the image is black
+    if x1 >= 0 and y1 >= 0 and x2 <= img.shape[1] and y2 <= img.shape[0]:
+        return img[y1:y2, x1:x2]
+    cropped = np.zeros((y2 - y1, x2 - x1) + img.shape[2:], dtype=img.dtype)
+    src_x1, src_y1 = max(x1, 0), max(y1, 0)
+    src_x2, src_y2 = min(x2, img.shape[1]), min(y2, img.shape[0])
+    if src_x1 < src_x2 and src_y1 < src_y2:
+        cropped[src_y1 - y1:src_y2 - y1, src_x1 - x1:src_x2 - x1] = img[src_y1:src_y2, src_x1:src_x2]
+    return cropped
+
+
+class ZipImageSource:
+    # images below one directory of a zip archive, decoded lazily as (name, BGR ndarray) pairs
+
+    def __init__(self, archive, prefix=""):
+        self._owns_archive = not isinstance(archive, zipfile.ZipFile)
+        self.archive = zipfile.ZipFile(archive, "r") if self._owns_archive else archive
+        prefix = prefix.strip("/")
+        self.prefix = prefix + "/" if prefix else ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        for name in self.names():
+            img = self.read(name)
+            if img is not None:
+                yield name, img
+
+    def close(self):
+        if self._owns_archive:
+            self.archive.close()
+
+    def names(self):
+        # image files directly in this directory, in archive order
+        names = []
+        for member in self.archive.namelist():
+            if member.startswith(self.prefix):
+                name = member[len(self.prefix):]
+                if name and "/" not in name and is_image(name):
+                    names.append(name)
+        return names
+
+    def subdirs(self):
+        subdirs = []
+        for member in self.archive.namelist():
+            if member.startswith(self.prefix):
+                parts = member[len(self.prefix):].split("/")
+                if len(parts) > 1 and parts[0] and parts[0] not in subdirs:
+                    subdirs.append(parts[0])
+        return subdirs
+
+    def child(self, subdir):
+        return ZipImageSource(self.archive, self.prefix + subdir)
+
+    def contains(self, name):
+        try:
+            self.archive.getinfo(self.prefix + name)
+            return True
+        except KeyError:
+            return False
+
+    def read_bytes(self, name):
+        return self.archive.read(self.prefix + name)
+
+    def read(self, name):
+        return decode_image(self.read_bytes(name))
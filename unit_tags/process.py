@@ -1,36 +1,49 @@
 """This script uses manually processed templates to identify unit types and formations in input images."""
 
 import os
+import sys
 import cv2
+import numpy as np
+from contextlib import contextmanager
+from types import SimpleNamespace
+try:
+    from instrumentation import span
+except ImportError:
+    # instrumentation.py sits in the repository root, without it on sys.path the stages just aren't timed
+    @contextmanager
+    def span(name, items=None):
+        yield SimpleNamespace(name=name, items=items)
 from unit_data_entry import UnitDataEntry, UnitType, UnitFormation, SpecialCases
+from image_source import ZipImageSource
+from classification_cache import ClassificationCache, roi_key
+import hashlib
 import json
-import zipfile
-import shutil
 
+FORMATION_TEMPLATE_DIR = "templates/unit_formation_templates"
+TYPE_TEMPLATE_DIR = "templates/unit_type_templates"
 
-def load_templates(template_dir, enum_cls):
+
+def load_templates(template_source, enum_cls):
     templates = {}
+    subdirs = template_source.subdirs()
     for entry in enum_cls:
-        entry_dir = os.path.join(template_dir, entry.value)
         entry_templates = []
-        if os.path.isdir(entry_dir):
-            for fname in os.listdir(entry_dir):
-                if fname.lower().endswith(('.png', '.jpg', '.jpeg')):
-                    path = os.path.join(entry_dir, fname)
-                    img = cv2.imread(path, cv2.IMREAD_COLOR)
-                    if img is not None:
-                        entry_templates.append(img)
-        else:
+        if entry.value in subdirs:
+            for _, img in template_source.child(entry.value):
+                entry_templates.append(img)
+        elif template_source.contains(f"{entry.value}.png"):
             # Fallback to single file
-            path = os.path.join(template_dir, f"{entry.value}.png")
-            if os.path.exists(path):
-                img = cv2.imread(path, cv2.IMREAD_COLOR)
-                if img is not None:
-                    entry_templates.append(img)
+            img = template_source.read(f"{entry.value}.png")
+            if img is not None:
+                entry_templates.append(img)
         templates[entry] = entry_templates
     return templates
 
 def match_template(image, templates, threshold=0.7):
+    best_match, _ = match_template_score(image, templates, threshold)
+    return best_match
+
+def match_template_score(image, templates, threshold=0.7):
     best_match = None
     best_score = 0.0
     for entry, template_list in templates.items():
@@ -47,93 +60,381 @@ def match_template(image, templates, threshold=0.7):
             if max_val > best_score and max_val > threshold:
                 best_score = max_val
                 best_match = entry
-    return best_match
+    return best_match, best_score
+
+FORMATION_ROI_SHAPE = (12, 41, 3)
+TYPE_ROI_SHAPE = (21, 41, 3)
+
+
+def normalize_roi(image):
+    # zero-mean (per channel) unit vector, so TM_CCOEFF_NORMED of two equally sized images is a dot product
+    vector = image.astype(np.float64)
+    vector -= vector.mean(axis=(0, 1))
+    vector = vector.ravel()
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+class TemplateMatrix:
+    # all templates of one enum, resized to the ROI shape and normalized once, one row per template
+
+    def __init__(self, templates, roi_shape):
+        self.templates = templates
+        self.roi_shape = roi_shape
+        self.entries = []
+        rows = []
+        flat = []
+        for entry, template_list in templates.items():
+            for template in template_list:
+                if template is None:
+                    continue
+                if template.shape != roi_shape:
+                    template = cv2.resize(template, (roi_shape[1], roi_shape[0]), interpolation=cv2.INTER_AREA)
+                row = normalize_roi(template)
+                self.entries.append(entry)
+                rows.append(row)
+                # cv2.matchTemplate scores a constant template as 1.0 against anything
+                flat.append(not row.any())
+        self.matrix = np.stack(rows) if rows else np.zeros((0, int(np.prod(roi_shape))))
+        self.flat = np.array(flat, dtype=bool)
+        self.by_value = {str(entry): entry for entry in self.entries}
+        # shape of what window() hands to scores()
+        self.window_shape = roi_shape
+
+        digest = hashlib.blake2b(str(roi_shape).encode(), digest_size=16)
+        digest.update(" ".join(str(entry) for entry in self.entries).encode())
+        digest.update(self.matrix.tobytes())
+        self._digest = digest.hexdigest()
+
+    def fingerprint(self, threshold):
+        # changes whenever a template is added, removed, edited or relabelled
+        return f"{self._digest}@{threshold}"
+
+    def window(self, img, top, left):
+        # the ROI at top/left, smaller than roi_shape when the counter is
+        return img[top:top + self.roi_shape[0], left:left + self.roi_shape[1]]
+
+    def scores(self, images, threshold=None):
+        # threshold: what match() will accept, lets approximate subclasses rescore ROIs that fall short
+        vectors = np.stack([normalize_roi(image) for image in images])
+        # float32 like cv2.matchTemplate, so exact matches tie at 1.0 the same way
+        scores = np.clip(vectors @ self.matrix.T, -1.0, 1.0).astype(np.float32)
+        scores[:, self.flat] = 1.0
+        return scores
+
+    def match(self, images, threshold=0.7):
+        # best (entry, score) for every image, same threshold rules as match_template
+        if len(images) == 0:
+            return []
+        if len(self.entries) == 0:
+            return [(None, 0.0)] * len(images)
+
+        scores = self.scores(images, threshold)
+        best = scores.argmax(axis=1)
+        best_scores = scores[np.arange(len(images)), best]
+        results = []
+        for index, score in zip(best, best_scores):
+            if score > threshold and score > 0.0:
+                results.append((self.entries[index], float(score)))
+            else:
+                results.append((None, 0.0))
+        return results
+
+
+class CascadeMatrix(TemplateMatrix):
+    # scores each ROI against one centroid per entry first, then only against the templates of its top_k entries,
+    ## or of its best entry alone when that centroid leads the runner-up by margin
+    ## the other scores are left at -1, so match() picks among the refined templates only
+    ## an ROI whose refined templates all stay at or below the threshold is rescored against every template,
+    ## so entries with dissimilar variants (a poor centroid) can't make it go untagged
+
+    def __init__(self, templates, roi_shape, top_k=3, margin=0.15):
+        super().__init__(templates, roi_shape)
+        self.top_k = top_k
+        self.margin = margin
+        self.entry_list = list(dict.fromkeys(self.entries))
+        entry_index = {entry: i for i, entry in enumerate(self.entry_list)}
+        self.template_entry = np.array([entry_index[entry] for entry in self.entries], dtype=int)
+        self.blocks = [np.flatnonzero(self.template_entry == i) for i in range(len(self.entry_list))]
+        centroids = []
+        for block in self.blocks:
+            rows = self.matrix[block[~self.flat[block]]]
+            centroid = rows.mean(axis=0) if len(rows) else np.zeros(self.matrix.shape[1])
+            norm = np.linalg.norm(centroid)
+            centroids.append(centroid / norm if norm > 0 else centroid)
+        self.centroids = np.stack(centroids) if centroids else np.zeros((0, self.matrix.shape[1]))
+        # a flat template scores 1.0 against anything, its entry is always refined
+        self.always = np.array([self.flat[block].any() for block in self.blocks], dtype=bool)
+
+    def fingerprint(self, threshold):
+        return f"{super().fingerprint(threshold)}/cascade{self.top_k},{self.margin},rescored"
+
+    def candidates(self, vectors):
+        # (ROI, entry) pairs worth refining
+        centroid_scores = vectors @ self.centroids.T
+        order = np.argsort(-centroid_scores, axis=1, kind="stable")
+        rows = np.arange(len(vectors))
+        candidates = np.zeros(centroid_scores.shape, dtype=bool)
+        candidates[rows, order[:, 0]] = True
+        if centroid_scores.shape[1] > 1:
+            undecided = centroid_scores[rows, order[:, 0]] - centroid_scores[rows, order[:, 1]] < self.margin
+            for rank in range(1, min(self.top_k, centroid_scores.shape[1])):
+                candidates[rows[undecided], order[undecided, rank]] = True
+        candidates[:, self.always] = True
+        return candidates
+
+    def scores(self, images, threshold=None):
+        vectors = np.stack([normalize_roi(image) for image in images])
+        candidates = self.candidates(vectors)
+        scores = np.full((len(images), len(self.entries)), -1.0, dtype=np.float32)
+        for i, block in enumerate(self.blocks):
+            rois = np.flatnonzero(candidates[:, i])
+            if len(rois):
+                block_scores = np.clip(vectors[rois] @ self.matrix[block].T, -1.0, 1.0).astype(np.float32)
+                block_scores[:, self.flat[block]] = 1.0
+                scores[np.ix_(rois, block)] = block_scores
+        if threshold is not None and len(scores):
+            missed = np.flatnonzero(scores.max(axis=1) <= max(threshold, 0.0))
+            if len(missed):
+                full = np.clip(vectors[missed] @ self.matrix.T, -1.0, 1.0).astype(np.float32)
+                full[:, self.flat] = 1.0
+                scores[missed] = full
+        return scores
+
+
+class ShiftMatrix(TemplateMatrix):
+    # scores every template at every offset up to shift pixels around the ROI and keeps the best one,
+    ## for counters whose symbol sits a pixel or two off the fixed ROI
+    ## window() cuts the ROI with a shift wide margin (edges replicated), scores() normalizes all offsets
+    ## of a batch of windows at once and scores them with one matrix product, batch_size bounds the memory
+
+    def __init__(self, templates, roi_shape, shift=1, batch_size=256):
+        super().__init__(templates, roi_shape)
+        self.shift = shift
+        self.batch_size = batch_size
+        self.window_shape = (roi_shape[0] + 2 * shift, roi_shape[1] + 2 * shift, *roi_shape[2:])
+
+    def fingerprint(self, threshold):
+        return f"{super().fingerprint(threshold)}/shift{self.shift}"
+
+    def window(self, img, top, left):
+        roi = super().window(img, top, left)
+        if roi.shape != self.roi_shape:
+            # odd sized counters keep the per-template path
+            return roi
+        s = self.shift
+        padded = cv2.copyMakeBorder(img, s, s, s, s, cv2.BORDER_REPLICATE)
+        return padded[top:top + self.window_shape[0], left:left + self.window_shape[1]]
+
+    def offset_vectors(self, windows):
+        # (windows, offsets, pixels), every offset normalized like normalize_roi
+        height, width = self.roi_shape[:2]
+        views = np.lib.stride_tricks.sliding_window_view(np.stack(windows), (height, width), axis=(1, 2))
+        # (windows, dy, dx, channels, height, width) -> (windows, offsets, height, width, channels)
+        views = views.transpose(0, 1, 2, 4, 5, 3).reshape(len(windows), -1, height, width, views.shape[3])
+        vectors = views.astype(np.float64)
+        vectors -= vectors.mean(axis=(2, 3), keepdims=True)
+        vectors = vectors.reshape(len(windows), views.shape[1], -1)
+        norms = np.linalg.norm(vectors, axis=2, keepdims=True)
+        return np.divide(vectors, norms, out=vectors, where=norms > 0)
+
+    def scores(self, images, threshold=None):
+        scores = np.empty((len(images), len(self.entries)), dtype=np.float32)
+        for start in range(0, len(images), self.batch_size):
+            vectors = self.offset_vectors(images[start:start + self.batch_size])
+            scores[start:start + len(vectors)] = np.clip((vectors @ self.matrix.T).max(axis=1), -1.0, 1.0)
+        scores[:, self.flat] = 1.0
+        return scores
+
+
+# top_k/margin of the CascadeMatrix, None scores every template (TemplateMatrix)
+## the cascade is approximate, check prune_templates.py's report for label changes before turning it on
+CASCADE_TOP_K = None
+CASCADE_MARGIN = 0.15
+# pixels the symbols may sit off their ROI (ShiftMatrix, scores every template so the cascade is skipped), 0 matches in place
+MATCH_SHIFT = 0
+
+
+def build_matrix(templates, roi_shape):
+    if MATCH_SHIFT:
+        return ShiftMatrix(templates, roi_shape, MATCH_SHIFT)
+    if CASCADE_TOP_K is None:
+        return TemplateMatrix(templates, roi_shape)
+    return CascadeMatrix(templates, roi_shape, CASCADE_TOP_K, CASCADE_MARGIN)
+
+
+def classify_images(images, type_matrix, formation_matrix, cache=None):
+    # images is a list of (filename, BGR image), one UnitDataEntry per image in the same order
+    with span("matching", len(images)):
+        formation_rois = [formation_matrix.window(img, 0, 0) for _, img in images]
+        type_rois = [type_matrix.window(img, 12, 0) for _, img in images]
+        formations = _match_rois(formation_rois, formation_matrix, 0.7, cache)
+        types = _match_rois(type_rois, type_matrix, 0.7, cache)
+    return [UnitDataEntry(filename, unit_type, unit_formation)
+            for (filename, _), (unit_type, _), (unit_formation, _) in zip(images, types, formations)]
+
+
+def _match_rois(rois, template_matrix, threshold, cache=None):
+    results = [None] * len(rois)
+    if cache is not None:
+        fingerprint = template_matrix.fingerprint(threshold)
+        keys = [roi_key(roi) for roi in rois]
+        for i, key in enumerate(keys):
+            cached = cache.lookup(fingerprint, key)
+            if cached is not None:
+                results[i] = (template_matrix.by_value.get(cached[0]), cached[1])
+    misses = [i for i, result in enumerate(results) if result is None]
+
+    # counters smaller than the ROI can't go into the matrix, they take the per-template path
+    batch = [i for i in misses if rois[i].shape == template_matrix.window_shape]
+    for i, result in zip(batch, template_matrix.match([rois[i] for i in batch], threshold)):
+        results[i] = result
+    for i, roi in enumerate(rois):
+        if results[i] is None:
+            results[i] = match_template_score(roi, template_matrix.templates, threshold)
+
+    if cache is not None:
+        for i in misses:
+            cache.store(fingerprint, keys[i], results[i][0], float(results[i][1]))
+    return results
+
 
 import asyncio
 
-async def process_single_image(filename, image_dir, type_templates, formation_templates):
-    if not filename.lower().endswith((".png", ".jpg", ".jpeg")):
-        return None
-    path = os.path.join(image_dir, filename)
-    img = await asyncio.to_thread(cv2.imread, path, cv2.IMREAD_COLOR)
+async def load_single_image(filename, image_source):
+    img = await asyncio.to_thread(image_source.read, filename)
     if img is None:
         return None
-    roi_formation = img[0:12, 0:41]
-    unit_formation = await asyncio.to_thread(match_template, roi_formation, formation_templates)
-    roi_type = img[12:33, 0:41]
-    unit_type = await asyncio.to_thread(match_template, roi_type, type_templates, 0.7)
-    return UnitDataEntry(filename, unit_type, unit_formation)
+    return filename, img
 
-async def process_images(image_dir, type_templates, formation_templates):
+async def process_images(image_source, type_matrix, formation_matrix, cache=None):
     tasks = []
-    for filename in os.listdir(image_dir):
-        tasks.append(process_single_image(filename, image_dir, type_templates, formation_templates))
-    results = await asyncio.gather(*tasks)
-    return [r for r in results if r is not None]
+    for filename in image_source.names():
+        tasks.append(load_single_image(filename, image_source))
+    images = [r for r in await asyncio.gather(*tasks) if r is not None]
+    return await asyncio.to_thread(classify_images, images, type_matrix, formation_matrix, cache)
 
-if __name__ == "__main__":
 
-    with zipfile.ZipFile("templates.zip", 'r') as zf:
-        zf.extractall("")
+from concurrent.futures import ProcessPoolExecutor
+
+# per worker process, filled once by _init_worker
+_worker_matrices = None
+_worker_images = None
+_worker_cache = None
 
-    with zipfile.ZipFile("input_images.zip", 'r') as zf:
-        zf.extractall("input_images")
+def _init_worker(images_zip, templates_zip, cache_tables):
+    global _worker_matrices, _worker_images, _worker_cache
+    # parallelism comes from the pool, keep OpenCV from oversubscribing the cores
+    cv2.setNumThreads(1)
+    with ZipImageSource(templates_zip) as template_source:
+        formation_matrix = build_matrix(load_templates(template_source.child(FORMATION_TEMPLATE_DIR), UnitFormation), FORMATION_ROI_SHAPE)
+        type_matrix = build_matrix(load_templates(template_source.child(TYPE_TEMPLATE_DIR), UnitType), TYPE_ROI_SHAPE)
+    _worker_matrices = (type_matrix, formation_matrix)
+    _worker_images = ZipImageSource(images_zip)
+    if cache_tables is not None:
+        _worker_cache = ClassificationCache(tables=cache_tables)
 
-    formation_templates = load_templates("templates/unit_formation_templates", UnitFormation)
-    type_templates = load_templates("templates/unit_type_templates", UnitType)
+def _process_chunk(filenames):
+    images = []
+    for filename in filenames:
+        img = _worker_images.read(filename)
+        if img is not None:
+            images.append((filename, img))
+    entries = classify_images(images, *_worker_matrices, _worker_cache)
+    # new cache entries travel back to the parent, which owns the file
+    return entries, _worker_cache.take_changes() if _worker_cache is not None else None
 
-    async def main():
-        entries_raw = await process_images("input_images", type_templates, formation_templates)
-        entries_raw += SpecialCases
-        entries = {entry.filename: entry.__dict__ for entry in entries_raw}
-        json.dump(entries, open("output.json", "w"), indent=4)
+def process_images_pool(images_zip, templates_zip, workers=None, chunk_size=64, cache=None):
+    # each worker loads the templates once, then classifies chunks of filenames, results come back in archive order
+    with ZipImageSource(images_zip) as image_source:
+        filenames = image_source.names()
+    chunks = [filenames[i:i + chunk_size] for i in range(0, len(filenames), chunk_size)]
+    results = []
+    cache_tables = cache.tables if cache is not None else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(images_zip, templates_zip, cache_tables)) as executor:
+        for chunk_results, cache_changes in executor.map(_process_chunk, chunks):
+            results += chunk_results
+            if cache is not None:
+                cache.merge(cache_changes)
+    return results
 
-    asyncio.run(main())
-    shutil.rmtree("templates")
-    shutil.rmtree("input_images")
+def classify_units(images_zip, templates_zip, workers=None, cache=None):
+    # images_zip: path or file object of the cropped counters, see preprocess_images.py
+    if workers is None or workers > 1:
+        return process_images_pool(images_zip, templates_zip, workers, cache=cache)
+    with ZipImageSource(templates_zip) as template_source, ZipImageSource(images_zip) as image_source:
+        with span("template loading"):
+            formation_templates = load_templates(template_source.child(FORMATION_TEMPLATE_DIR), UnitFormation)
+            type_templates = load_templates(template_source.child(TYPE_TEMPLATE_DIR), UnitType)
+            formation_matrix = build_matrix(formation_templates, FORMATION_ROI_SHAPE)
+            type_matrix = build_matrix(type_templates, TYPE_ROI_SHAPE)
+        return asyncio.run(process_images(image_source, type_matrix, formation_matrix, cache))
 
+def filter_unit_tags(entries, purged_path="purged.csv"):
+    # entries: {filename: UnitDataEntry.__dict__}, returns the unit_tags.json list
     data_out = []
-    with open("output.json", 'r') as f:
-        with open("purged.csv", 'w') as csvfile:
-            csvfile.write("purged filename\n")
-            data_in = json.load(f)
-
-            for entry_filename, entry in data_in.items():
-                if entry['unit_type'] is None and entry['unit_formation'] is None:
-                    # Filter out entries that are not relevant
-                    if ("_F_" in entry_filename) and\
-                        ("Mrk" not in entry_filename) and\
-                        ("Naval" not in entry_filename) and\
-                        ("Air" not in entry_filename) and\
-                        ("Helo" not in entry_filename):
-                        csvfile.write(f"{entry_filename}\n")
-                    else:
-                        continue
+    with open(purged_path, 'w') as csvfile:
+        csvfile.write("purged filename\n")
+
+        for entry_filename, entry in entries.items():
+            if entry['unit_type'] is None and entry['unit_formation'] is None:
+                # Filter out entries that are not relevant
+                if ("_F_" in entry_filename) and\
+                    ("Mrk" not in entry_filename) and\
+                    ("Naval" not in entry_filename) and\
+                    ("Air" not in entry_filename) and\
+                    ("Helo" not in entry_filename):
+                    csvfile.write(f"{entry_filename}\n")
                 else:
-                    data_out.append(entry)
-        
-    with open("unit_tags.json", 'w') as f:
+                    continue
+            else:
+                data_out.append(entry)
+    print(f"Filtered {len(entries) - len(data_out)} entries with no unit_formation and no unit_type.")
+    return data_out
+
+def check_unit_tags(unit_tags):
+    invalid_entries = [entry for entry in unit_tags if entry['unit_type'] is None]
+
+    if invalid_entries:
+        print("Entries with (no unit_type), or (no unit_type and no unit_formation)")
+        for entry in invalid_entries:
+            print(f" - {entry["filename"]} {entry["unit_type"]} {entry["unit_formation"]}")
+    else:
+        print("All entries have valid unit_type or unit_formation.")
+
+if __name__ == "__main__":
+    # run from unit_tags/, the repository root has instrumentation.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from instrumentation import recorder, span
+
+    workers = os.cpu_count()    # 1 keeps everything in this process (asyncio loading)
+    debug = False               # True also writes the raw classification to output.json
+    instrument = False          # stage timings to process_report.json, the pool's workers are timed as a whole
+    profile_dir = None          # e.g. "./profiles", one cProfile dump per stage
+    recorder.configure(instrument, profile_dir=profile_dir)
+    cache = ClassificationCache("classification_cache.json")
+
+    with span("classification") as stage:
+        entries_raw = classify_units("input_images.zip", "templates.zip", workers, cache)
+        stage.items = len(entries_raw)
+
+    cache.save()
+    print(f"Classification cache: {cache.hits} hits, {cache.misses} misses.")
+
+    entries_raw += SpecialCases
+    entries = {entry.filename: entry.__dict__ for entry in entries_raw}
+    if debug:
+        with open("output.json", "w") as f:
+            json.dump(entries, f, indent=4)
+
+    data_out = filter_unit_tags(entries, "purged.csv")
+    with open("unit_tags.json", 'w') as f, span("json dump", len(data_out)):
         json.dump(data_out, f, indent=4)
-        print(f"Filtered {len(data_in) - len(data_out)} entries with no unit_formation and no unit_type.")
         print(f"Saved {len(data_out)} entries to parsed_output.json.")
 
-    with open("unit_tags.json", 'r') as f:
-        data = json.load(f)
-
-        invalid_entries = []
-        for entry in data:
-            if entry['unit_type'] is None:
-                invalid_entries.append(entry)
-            elif entry['unit_formation'] is None:
-                entry["unit_formation"] = UnitFormation.COMPANY
-            elif (entry['unit_type'] is None) and (entry['unit_formation'] is None):
-                invalid_entries.append(entry)
-            else:
-                continue
-
-        if invalid_entries:
-            print("Entries with (no unit_type), or (no unit_type and no unit_formation)")
-            for entry in invalid_entries:
-                print(f" - {entry["filename"]} {entry["unit_type"]} {entry["unit_formation"]}")
-        else:
-            print("All entries have valid unit_type or unit_formation.")
\ No newline at end of file
+    check_unit_tags(data_out)
+    if instrument:
+        recorder.report("process_report.json")
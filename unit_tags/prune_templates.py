@@ -0,0 +1,124 @@
+"""Drops templates from templates.zip that no input image needs, keeping every label process.py assigns unchanged."""
+import json
+import zipfile
+
+import numpy as np
+
+from image_source import ZipImageSource, encode_image
+from process import (FORMATION_TEMPLATE_DIR, TYPE_TEMPLATE_DIR, FORMATION_ROI_SHAPE, TYPE_ROI_SHAPE,
+                     TemplateMatrix, CascadeMatrix, CASCADE_TOP_K, CASCADE_MARGIN)
+from unit_data_entry import UnitType, UnitFormation
+
+
+def load_named_templates(template_source, enum_cls):
+    # like load_templates, but keeps the file names so the survivors can be written back
+    templates = {}
+    subdirs = template_source.subdirs()
+    for entry in enum_cls:
+        if entry.value in subdirs:
+            entry_source = template_source.child(entry.value)
+            templates[entry] = [(f"{entry.value}/{name}", img) for name, img in entry_source]
+        elif template_source.contains(f"{entry.value}.png"):
+            img = template_source.read(f"{entry.value}.png")
+            templates[entry] = [(f"{entry.value}.png", img)] if img is not None else []
+        else:
+            templates[entry] = []
+    return templates
+
+
+def labels(named_templates, rois, roi_shape, matrix_cls=TemplateMatrix, **kwargs):
+    matrix = matrix_cls({entry: [img for _, img in named] for entry, named in named_templates.items()}, roi_shape, **kwargs)
+    return [entry for entry, _ in matrix.match(rois)]
+
+
+def best_templates(scores, keep, entries, threshold=0.7):
+    # TemplateMatrix.match over the kept columns of a precomputed score matrix
+    masked = np.where(keep, scores, -np.inf)
+    best = masked.argmax(axis=1)
+    best_scores = masked[np.arange(len(scores)), best]
+    return best, [entries[b] if score > threshold and score > 0.0 else None for b, score in zip(best, best_scores)]
+
+
+def redundancy_order(matrix):
+    # columns most similar to another template of the same entry first, those are the likeliest to go
+    same_entry = np.array(matrix.entries, dtype=object)
+    same_entry = same_entry[:, None] == same_entry[None, :]
+    similarity = np.where(same_entry, matrix.matrix @ matrix.matrix.T, -np.inf)
+    np.fill_diagonal(similarity, -np.inf)
+    nearest = similarity.max(axis=1) if len(similarity) else similarity
+    return [(float(nearest[column]), column) for column in np.argsort(-nearest, kind="stable") if np.isfinite(nearest[column])]
+
+
+def prune(named_templates, rois, roi_shape):
+    # greedy: a template goes when the labels of all rois stay the same without it, every entry keeps one template
+    ## only the rois whose best template is the one being dropped can change, so only those are rescored
+    matrix = TemplateMatrix({entry: [img for _, img in named] for entry, named in named_templates.items()}, roi_shape)
+    names = [name for named in named_templates.values() for name, _ in named]
+    scores = matrix.scores(rois) if rois else np.zeros((0, len(names)), dtype=np.float32)
+    keep = np.ones(len(names), dtype=bool)
+    best, reference = best_templates(scores, keep, matrix.entries)
+
+    pruned = []
+    for similarity, column in redundancy_order(matrix):
+        entry = matrix.entries[column]
+        if sum(1 for other in np.flatnonzero(keep) if matrix.entries[other] == entry) < 2:
+            continue
+        keep[column] = False
+        affected = np.flatnonzero(best == column)
+        affected_best, affected_labels = best_templates(scores[affected], keep, matrix.entries)
+        if all(label == reference[roi] for roi, label in zip(affected, affected_labels)):
+            best[affected] = affected_best
+            pruned.append({"entry": str(entry), "template": names[column], "similarity": similarity})
+        else:
+            keep[column] = True
+
+    kept = {entry: [] for entry in named_templates}
+    for column, (name, img) in enumerate(item for named in named_templates.values() for item in named):
+        if keep[column]:
+            kept[matrix.entries[column]].append((name, img))
+    return kept, pruned, reference
+
+
+def write_templates(dst_zip, directory, named_templates):
+    for named in named_templates.values():
+        for name, img in named:
+            dst_zip.writestr(f"{directory}/{name}", encode_image(name, img))
+
+
+if __name__ == "__main__":
+    templates_zip = "templates.zip"
+    images_zip = "input_images.zip"     # from preprocess_images.py, the rois the labels are checked on
+    pruned_zip = "templates_pruned.zip"
+    report_path = "prune_report.json"
+
+    report = {}
+    with ZipImageSource(templates_zip) as template_source, ZipImageSource(images_zip) as image_source:
+        images = [img for _, img in image_source]
+        enums = (
+            ("unit_formation_templates", FORMATION_TEMPLATE_DIR, UnitFormation, FORMATION_ROI_SHAPE, [img[0:12, 0:41] for img in images]),
+            ("unit_type_templates", TYPE_TEMPLATE_DIR, UnitType, TYPE_ROI_SHAPE, [img[12:33, 0:41] for img in images]),
+        )
+        with zipfile.ZipFile(pruned_zip, "w", zipfile.ZIP_DEFLATED) as dst_zip:
+            for name, directory, enum_cls, roi_shape, rois in enums:
+                # only rois the matrix takes, odd sized counters keep using every template anyway
+                rois = [roi for roi in rois if roi.shape == roi_shape]
+                named_templates = load_named_templates(template_source.child(directory), enum_cls)
+                kept, pruned, reference = prune(named_templates, rois, roi_shape)
+                write_templates(dst_zip, directory, kept)
+
+                pruned_labels = labels(kept, rois, roi_shape)
+                cascade_labels = labels(kept, rois, roi_shape, CascadeMatrix, top_k=CASCADE_TOP_K or 3, margin=CASCADE_MARGIN)
+                report[name] = {
+                    "rois":                 len(rois),
+                    "templates_before":     sum(len(named) for named in named_templates.values()),
+                    "templates_after":      sum(len(named) for named in kept.values()),
+                    "labels_changed":       sum(1 for a, b in zip(reference, pruned_labels) if a != b),
+                    "cascade_labels_changed": sum(1 for a, b in zip(reference, cascade_labels) if a != b),
+                    "pruned":               pruned
+                }
+                print(f"{name}: {report[name]['templates_before']} -> {report[name]['templates_after']} templates, "
+                      f"{report[name]['labels_changed']} labels changed, {report[name]['cascade_labels_changed']} with the cascade")
+
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Wrote {pruned_zip} and {report_path}.")